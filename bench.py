@@ -0,0 +1,589 @@
+#!/usr/bin/env python3
+
+""" Offline benchmarks of the scrapers, statistics and exporters.
+
+Synthetic Zeit pages, Spiegel fragments, Disqus threads and Graph API
+responses are served by a local stub server (in its own process), and a
+synthetic snapshot is written for the statistics and exporters. The
+throughput and peak memory of every benchmark are appended to a results
+file, so that runs can be compared:
+
+    ./bench.py --comments 100000
+    ./bench.py --compare
+"""
+
+from __future__ import unicode_literals
+
+import argparse
+import http.server
+import io
+import json
+import math
+import multiprocessing
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import urllib.parse
+
+import fbcomments
+
+WORDS = (
+    'die der und in zu den das nicht von sie ist des sich mit dem dass er '
+    'es ein ich auf so eine auch als an nach wie im für man aber aus durch '
+    'wenn nur war noch werden bei hat wir was wird sein einen welche sind '
+    'oder zur um haben einer mir über ihm diese einem ihr uns da zum kann '
+    'doch vor dieser mich ihn du hatte seine mehr am denn nun unter sehr '
+    'selbst schon hier bis habe ihre dann ihnen seiner alle wieder meine '
+    'Zeit gegen vom ganz einzelnen wo muss ohne eines können sei Regierung '
+    'Bürger Politik Wahl Europa Steuern Schule Bahn Wetter Fußball').split()
+
+BENCH_HOSTS = (
+    'graph.facebook.com', 'www.zeit.de', 'www.spiegel.de', 'www.welt.de',
+    'disqus.com')
+
+
+class Fixtures(object):
+    """ Deterministic synthetic data with about `comments` comments per
+    site. Everything is computed from indices, so that even 10⁶ comments
+    need no memory in the stub server. """
+
+    ZEIT_PER_PAGE = 20
+    SPIEGEL_PER_PAGE = 5
+    DISQUS_PER_PAGE = 100
+    GRAPH_PAGE_SIZE = 200
+    GRAPH_PER_POST = 500
+    GRAPH_LIKES = 50
+
+    def __init__(self, comments):
+        self.comments = comments
+        self.users = max(10, comments // 5)
+        self.posts = int(math.ceil(comments / self.GRAPH_PER_POST))
+
+    def user(self, i):
+        # About every second name is shared by two users
+        uid = (i * 7919) % self.users
+        return str(100000 + uid), 'Benutzer %d' % (uid % (self.users // 2))
+
+    def text(self, i, words=30):
+        length = 5 + (i * 31) % words
+        return ' '.join(
+            WORDS[(i * 17 + k * 13) % len(WORDS)] for k in range(length))
+
+    def created_time(self, i):
+        return time.strftime(
+            '%Y-%m-%dT%H:%M:%S+0000', time.gmtime(1420070400 + i * 60))
+
+    def is_reply(self, i):
+        return i % 4 == 3
+
+    # Graph API
+
+    def graph_post_id(self, j):
+        return '4711_%d' % j
+
+    def graph_comment(self, j, i):
+        uid, name = self.user(j * self.GRAPH_PER_POST + i)
+        c = {
+            'id': '%s_%d' % (self.graph_post_id(j), i),
+            'created_time': self.created_time(i),
+            'message': self.text(i),
+            'like_count': i % 7,
+            'from': {'id': uid, 'name': name},
+        }
+        if self.is_reply(i):
+            c['parent'] = {'id': '%s_%d' % (self.graph_post_id(j), i - 1)}
+        return c
+
+    def graph_comment_count(self, j):
+        return min(
+            self.GRAPH_PER_POST, self.comments - j * self.GRAPH_PER_POST)
+
+    def graph_comments(self, j, start):
+        """ Returns a Graph API page of comments of post j """
+        count = self.graph_comment_count(j)
+        end = min(count, start + self.GRAPH_PAGE_SIZE)
+        page = {
+            'data': [self.graph_comment(j, i) for i in range(start, end)]}
+        if end < count:
+            page['paging'] = {'next': (
+                'https://graph.facebook.com/v2.2/%s/comments?after=%d' % (
+                    self.graph_post_id(j), end))}
+        return page
+
+    def graph_likes(self, j):
+        return {'data': [
+            dict(zip(('id', 'name'), self.user(j * 31 + k)))
+            for k in range(self.GRAPH_LIKES)]}
+
+    def graph_post(self, j, with_edges=True):
+        post = {
+            'id': self.graph_post_id(j),
+            'created_time': self.created_time(j),
+            'message': self.text(j, words=80),
+            'type': 'status',
+            'shares': {'count': j % 100},
+            'from': {'id': '4711', 'name': 'Bench-Seite'},
+        }
+        if with_edges:
+            post['comments'] = self.graph_comments(j, 0)
+            post['likes'] = self.graph_likes(j)
+        return post
+
+    def graph_feed(self, start):
+        end = min(self.posts, start + self.GRAPH_PAGE_SIZE)
+        page = {'data': [
+            {'id': self.graph_post_id(j), 'message': self.text(j)}
+            for j in range(start, end)]}
+        if end < self.posts:
+            page['paging'] = {'next': (
+                'https://graph.facebook.com/v2.2/benchpage/feed?after=%d' %
+                end)}
+        return page
+
+    # Zeit
+
+    def zeit_page_count(self):
+        return max(1, int(math.ceil(self.comments / self.ZEIT_PER_PAGE)))
+
+    def zeit_article(self):
+        return (
+            '<html><head><title>Zeit</title></head><body>'
+            '<span class="article-heading__title">Bench-Zeit-Artikel</span>'
+            '<ul class="pager">'
+            '<li class="pager__page">'
+            '<a href="http://www.zeit.de/bench/article?page=%d#comments">'
+            '%d</a></li></ul></body></html>') % (
+                self.zeit_page_count(), self.zeit_page_count())
+
+    def zeit_page(self, page):
+        start = (page - 1) * self.ZEIT_PER_PAGE
+        end = min(self.comments, start + self.ZEIT_PER_PAGE)
+        parts = [
+            '<html><body><script>var x = "<article>";</script>'
+            '<section class="comment-section" id="comments">']
+        for i in range(start, end):
+            uid, name = self.user(i)
+            parts.append(
+                '<article class="comment%s" id="cid-%d">'
+                '<svg><use href="#icon"/></svg>'
+                '<div class="comment-meta__name">'
+                '<a href="https://community.zeit.de/user/%s">%s</a></div>'
+                '<div class="comment__body"><p>%s&nbsp;&amp; %s</p>'
+                '<p>%s</p></div></article>' % (
+                    '' if self.is_reply(i) and i > start
+                    else ' js-comment-toplevel',
+                    i, uid, name, self.text(i), self.text(i + 1),
+                    self.text(i + 2)))
+        parts.append('</section></body></html>')
+        return ''.join(parts)
+
+    # Spiegel
+
+    def spiegel_article(self):
+        return (
+            '<html><body>'
+            '<h2 class="article-title"><span>Bench</span> Spiegel-Artikel</h2>'
+            '<span>insgesamt %d Beiträge</span>'
+            '<input type="hidden" name="threadid" value="4711" />'
+            '</body></html>') % self.comments
+
+    def spiegel_fragment(self, offset):
+        parts = []
+        for i in range(
+                max(0, offset - self.SPIEGEL_PER_PAGE),
+                min(self.comments, offset)):
+            uid, name = self.user(i)
+            parts.append(
+                '<div class="article-comment">'
+                '<div class="article-comment-user">'
+                '<a href="/forum/member-%s.html">%s</a> %s</div>'
+                '<div class="js-article-post-full-text">%s<br/>%s</div>'
+                '</div>' % (
+                    uid, name, self.created_time(i), self.text(i),
+                    self.text(i + 1)))
+        return ''.join(parts)
+
+    # Welt / Disqus
+
+    def welt_article(self):
+        return (
+            '<html><head>'
+            '<meta property="og:title" content="Bench-Welt-Artikel"/>'
+            '</head><body><script>'
+            "var disqus_shortname='welt-bench';"
+            'var disqus_identifier = 4711;'
+            '</script></body></html>')
+
+    def disqus_embed(self):
+        return '<html><script>{"thread":"999","forum":"welt"}</script></html>'
+
+    def disqus_page(self, cursor):
+        start = int(cursor.split(':')[0])
+        end = min(self.comments, start + self.DISQUS_PER_PAGE)
+        response = []
+        for i in range(start, end):
+            uid, name = self.user(i)
+            response.append({
+                'id': str(i + 1),
+                'author': {'name': name, 'username': 'u%s' % uid},
+                'createdAt': self.created_time(i),
+                'likes': i % 5,
+                'raw_message': self.text(i),
+                'parent': i if self.is_reply(i) else None,
+            })
+        return {
+            'cursor': {'hasNext': end < self.comments, 'next': '%d:0:0' % end},
+            'response': response,
+        }
+
+
+class _StubHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    fixtures = None
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, body, content_type='text/html; charset=UTF-8'):
+        if not isinstance(body, str):
+            body = json.dumps(body)
+            content_type = 'application/json'
+        b = body.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(b)))
+        self.end_headers()
+        self.wfile.write(b)
+
+    def _graph(self, path, query):
+        f = self.fixtures
+        parts = path.split('/')[2:]
+        if parts == ['benchpage', 'feed']:
+            return f.graph_feed(int(query.get('after', 0)))
+        j = int(parts[0].split('_')[1])
+        if len(parts) == 1:
+            return f.graph_post(j)
+        if parts[1] == 'comments':
+            return f.graph_comments(j, int(query.get('after', 0)))
+        return f.graph_likes(j)
+
+    def do_POST(self):
+        length = int(self.headers['Content-Length'])
+        body = urllib.parse.parse_qs(self.rfile.read(length).decode('utf-8'))
+        res = []
+        for r in json.loads(body['batch'][0]):
+            url = urllib.parse.urlsplit('/' + r['relative_url'])
+            res.append({'code': 200, 'headers': [], 'body': json.dumps(
+                self._graph(url.path, dict(urllib.parse.parse_qsl(url.query)))
+            )})
+        self._send(res)
+
+    def do_GET(self):
+        f = self.fixtures
+        host = self.headers['Host']
+        url = urllib.parse.urlsplit(self.path)
+        query = dict(urllib.parse.parse_qsl(url.query))
+        if host == 'graph.facebook.com':
+            self._send(self._graph(url.path, query))
+        elif host == 'www.zeit.de':
+            if 'page' in query:
+                self._send(f.zeit_page(int(query['page'])))
+            else:
+                self._send(f.zeit_article())
+        elif host == 'www.spiegel.de':
+            if url.path.startswith('/fragments/'):
+                offset = int(url.path.rpartition('-')[2].partition('.')[0])
+                self._send(f.spiegel_fragment(offset))
+            else:
+                self._send(f.spiegel_article())
+        elif host == 'www.welt.de':
+            self._send(f.welt_article())
+        elif host == 'disqus.com':
+            if url.path.startswith('/embed/'):
+                self._send(f.disqus_embed())
+            else:
+                self._send(f.disqus_page(query['cursor']))
+        else:
+            self.send_error(404)
+
+
+def _serve(comments, conn):
+    _StubHandler.fixtures = Fixtures(comments)
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), _StubHandler)
+    conn.send(server.server_port)
+    server.serve_forever()
+
+
+def start_stub_server(comments):
+    """ Starts the stub server in a separate process, so that it does not
+    distort the measurements. Returns (process, base URL). """
+    parent_conn, child_conn = multiprocessing.Pipe()
+    proc = multiprocessing.Process(
+        target=_serve, args=(comments, child_conn), daemon=True)
+    proc.start()
+    port = parent_conn.recv()
+    return proc, 'http://127.0.0.1:%d' % port
+
+
+def write_snapshot(config, d, fixtures):
+    """ Writes a snapshot of the synthetic Facebook page, as downloaded by
+    download_facebook_page. Returns the number of comments. """
+    feed = []
+    for j in range(fixtures.posts):
+        post_id = fixtures.graph_post_id(j)
+        feed.append({'id': post_id, 'message': fixtures.text(j)})
+        fbcomments._write_data(
+            config, d, 'post_%s' % post_id, fixtures.graph_post(j, False))
+        fbcomments._write_records(
+            config, d, 'comments_%s' % post_id, (
+                fixtures.graph_comment(j, i)
+                for i in range(fixtures.graph_comment_count(j))))
+        fbcomments._write_records(
+            config, d, 'likes_%s' % post_id, fixtures.graph_likes(j)['data'])
+    fbcomments._write_data(config, d, 'feed', feed)
+    return fixtures.comments
+
+
+# Benchmarks are functions (config, d, fixtures) -> number of comments
+# processed, run in this order. d is the latest snapshot.
+
+def bench_scrape_zeit(config, d, fixtures):
+    fbcomments.download_zeit(config, d, 'http://www.zeit.de/bench/article')
+    return fixtures.comments
+
+
+def bench_scrape_spiegel(config, d, fixtures):
+    fbcomments.download_spiegel(
+        config, d, 'http://www.spiegel.de/bench/article')
+    return fixtures.comments
+
+
+def bench_scrape_disqus(config, d, fixtures):
+    fbcomments.download_welt(config, d, 'https://www.welt.de/bench/article')
+    return fixtures.comments
+
+
+def bench_scrape_graph(config, d, fixtures):
+    scratch = os.path.join(os.path.dirname(d), 'graph')
+    os.mkdir(scratch)
+    try:
+        fbcomments.download_facebook_page(config, scratch, 'benchpage')
+    finally:
+        shutil.rmtree(scratch)
+    return fixtures.comments
+
+
+def bench_write_snapshot(config, d, fixtures):
+    return write_snapshot(config, d, fixtures)
+
+
+def bench_read_all(config, d, fixtures):
+    return sum(len(post['comments']) for post in fbcomments._read_all(d))
+
+
+def bench_feed_stats(config, d, fixtures):
+    fbcomments._feed_stats(fbcomments._iter_feed(d))
+    return fixtures.comments
+
+
+def bench_export_tables(config, d, fixtures):
+    fbcomments.action_export_tables(config, [['benchpage']])
+    return fixtures.comments
+
+
+def bench_write_page_x(config, d, fixtures):
+    fbcomments.action_write_page_x(config, [['benchpage']])
+    return fixtures.comments
+
+
+def bench_write_x(config, d, fixtures):
+    fbcomments.action_write_x(dict(config, xlsx_workers=1), [
+        ['http://www.zeit.de/bench/article'],
+        ['http://www.spiegel.de/bench/article'],
+        ['https://www.welt.de/bench/article'],
+    ])
+    return 3 * fixtures.comments
+
+
+BENCHMARKS = [
+    ('scrape_zeit', bench_scrape_zeit),
+    ('scrape_spiegel', bench_scrape_spiegel),
+    ('scrape_disqus', bench_scrape_disqus),
+    ('scrape_graph', bench_scrape_graph),
+    ('write_snapshot', bench_write_snapshot),
+    ('read_all', bench_read_all),
+    ('feed_stats', bench_feed_stats),
+    ('export_tables', bench_export_tables),
+    ('write_page_x', bench_write_page_x),
+    ('write_x', bench_write_x),
+]
+# Benchmarks which need the output of others. These are run untimed first
+# when they are not selected themselves.
+BENCHMARK_REQUIRES = {
+    'read_all': ['write_snapshot'],
+    'feed_stats': ['write_snapshot'],
+    'export_tables': ['write_snapshot'],
+    'write_page_x': ['write_snapshot'],
+    'write_x': ['scrape_zeit', 'scrape_spiegel', 'scrape_disqus'],
+}
+XLSX_BENCHMARKS = ('write_page_x', 'write_x')
+
+
+def _run(name, func, config, d, fixtures, trace_memory):
+    if trace_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    items = func(config, d, fixtures)
+    seconds = time.perf_counter() - start
+    peak = None
+    if trace_memory:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return {
+        'seconds': seconds,
+        'comments': items,
+        'comments_per_second': items / seconds if seconds else None,
+        'peak_memory': peak,
+    }
+
+
+def _git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    try:
+        import xlsxwriter  # noqa: F401
+        has_xlsx = True
+    except ImportError:
+        has_xlsx = False
+
+    fixtures = Fixtures(args.comments)
+    proc, base_url = start_stub_server(args.comments)
+    tmp = tempfile.mkdtemp(prefix='fbcomments-bench-')
+    try:
+        config = {
+            'access_token': 'bench',
+            'download_location': tmp,
+            'disqus_version': 'bench',
+            'disqus_api_key': 'bench',
+            'storage_format': args.storage_format,
+            'page_workers': args.page_workers,
+            'http_host_overrides': {host: base_url for host in BENCH_HOSTS},
+        }
+        d = os.path.join(tmp, '2016-01-01T00:00:00')
+        os.mkdir(d)
+        results = {}
+        funcs = dict(BENCHMARKS)
+        done = set()
+        for name, func in BENCHMARKS:
+            if args.only and name not in args.only:
+                continue
+            if name in XLSX_BENCHMARKS and not has_xlsx:
+                print('%-16s skipped (xlsxwriter is not installed)' % name)
+                continue
+            for required in BENCHMARK_REQUIRES.get(name, []):
+                if required not in done:
+                    funcs[required](config, d, fixtures)
+                    done.add(required)
+            done.add(name)
+            res = _run(name, func, config, d, fixtures, not args.no_memory)
+            results[name] = res
+            print('%-16s %8.2fs %12.0f comments/s %s' % (
+                name, res['seconds'], res['comments_per_second'] or 0,
+                '' if res['peak_memory'] is None
+                else '%8.1f MiB peak' % (res['peak_memory'] / 2 ** 20)))
+        fbcomments._http(config).close()
+    finally:
+        proc.terminate()
+        shutil.rmtree(tmp)
+
+    run_info = {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'revision': _git_revision(),
+        'python': platform.python_version(),
+        'comments': args.comments,
+        'storage_format': args.storage_format,
+        'results': results,
+    }
+    with io.open(args.results, 'a', encoding='utf-8') as resultsf:
+        resultsf.write(json.dumps(run_info) + '\n')
+    print('Appended results to %s' % args.results)
+
+
+def compare(args):
+    """ Compares the last two runs in the results file with the same number
+    of comments """
+    if not os.path.exists(args.results):
+        sys.exit('No results file %s' % args.results)
+    with io.open(args.results, 'r', encoding='utf-8') as resultsf:
+        runs = [json.loads(line) for line in resultsf if line.strip()]
+    if not runs:
+        sys.exit('No runs in %s' % args.results)
+    new = runs[-1]
+    same_scale = [r for r in runs[:-1] if r['comments'] == new['comments']]
+    if not same_scale:
+        sys.exit('No earlier run with %d comments' % new['comments'])
+    old = same_scale[-1]
+    print('%s (%s) -> %s (%s), %d comments' % (
+        old['time'], old['revision'], new['time'], new['revision'],
+        new['comments']))
+    for name, res in new['results'].items():
+        old_res = old['results'].get(name)
+        if not old_res:
+            continue
+        memory = ''
+        if res['peak_memory'] and old_res['peak_memory']:
+            memory = '  memory x%.2f' % (
+                res['peak_memory'] / old_res['peak_memory'])
+        print('%-16s %8.2fs -> %8.2fs  speedup x%.2f%s' % (
+            name, old_res['seconds'], res['seconds'],
+            old_res['seconds'] / res['seconds'], memory))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        'Benchmark fbcomments with synthetic data')
+    parser.add_argument(
+        '--comments', type=int, default=10000, metavar='N',
+        help='Number of comments per site (default: %(default)s)')
+    parser.add_argument(
+        '--only', action='append', metavar='NAME',
+        choices=[name for name, _ in BENCHMARKS],
+        help='Only run this benchmark (can be given multiple times)')
+    parser.add_argument(
+        '--storage-format', default='json',
+        choices=sorted(fbcomments.STORAGE_SUFFIXES),
+        help='Storage format of the snapshots (default: %(default)s)')
+    parser.add_argument(
+        '--page-workers', type=int, default=4, metavar='N',
+        help='Concurrent page downloads per article (default: %(default)s)')
+    parser.add_argument(
+        '--no-memory', action='store_true',
+        help='Do not trace peak memory, which slows down the benchmarks')
+    parser.add_argument(
+        '--results', metavar='FILE', default='bench_results.jsonl',
+        help='File to append the results to (default: %(default)s)')
+    parser.add_argument(
+        '--compare', action='store_true',
+        help='Compare the last two runs in the results file and exit')
+    args = parser.parse_args()
+    if args.compare:
+        compare(args)
+    else:
+        run(args)
+
+
+if __name__ == '__main__':
+    main()
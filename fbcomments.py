@@ -3,18 +3,32 @@
 from __future__ import unicode_literals
 
 import argparse
+import array
 import collections
+import concurrent.futures
+import csv
+import functools
+import gzip
+import hashlib
+import heapq
+import html
+import html.parser
+import http.client
 import io
 import itertools
 import json
 import os
+import random
 import re
+import shutil
+import sqlite3
 import sys
+import threading
 import time
+import traceback
 import urllib.error
 import urllib.parse
-import urllib.request
-import xml.etree.ElementTree
+import zlib
 
 #
 # Data structure
@@ -35,94 +49,1566 @@ def _read_json(fn):
         return json.load(jsonf)
 
 
-def graph_api(config, path, params={}, filter_func=None):
+class _MetricsTimer(object):
+    """ Context manager adding the time spent in it to a phase.
+
+    If path is set, the size of that file is recorded as bytes on exit. """
+
+    def __init__(self, metrics, phase, site, path=None):
+        self.metrics = metrics
+        self.phase = phase
+        self.site = site
+        self.path = path
+        self.bytes = 0
+        self._excluded = 0.0
+
+    def __enter__(self):
+        self._start = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if self.path and os.path.exists(self.path):
+            self.bytes = os.path.getsize(self.path)
+        self.metrics.add(
+            self.phase, self.site,
+            time.monotonic() - self._start - self._excluded, self.bytes)
+
+    def exclude(self, iterable):
+        """ Yields the elements of iterable, without counting the time
+        spent producing them (e.g. downloading) """
+        it = iter(iterable)
+        while True:
+            start = time.monotonic()
+            try:
+                el = next(it)
+            except StopIteration:
+                return
+            finally:
+                self._excluded += time.monotonic() - start
+            yield el
+
+
+class _NullTimer(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        pass
+
+    def exclude(self, iterable):
+        return iterable
+
+
+class Metrics(object):
+    """ Collects the time spent (and bytes processed) per phase and site,
+    and statistics of all HTTP requests per host.
+
+    Snapshot I/O happens without access to the configuration, so there is
+    one module-wide instance, METRICS. It costs nothing until enabled. """
+
+    def __init__(self):
+        self.enabled = False
+        self._lock = threading.Lock()
+        self._null_timer = _NullTimer()
+        self.reset()
+
+    def reset(self):
+        self.start = time.time()
+        # (phase, site) -> [count, seconds, bytes]
+        self.phases = collections.OrderedDict()
+        # host -> dict of request statistics
+        self.requests = collections.OrderedDict()
+
+    def add(self, phase, site, seconds, nbytes=0):
+        if not self.enabled:
+            return
+        with self._lock:
+            entry = self.phases.setdefault((phase, site), [0, 0.0, 0])
+            entry[0] += 1
+            entry[1] += seconds
+            entry[2] += nbytes
+
+    def timer(self, phase, site=None, path=None):
+        if not self.enabled:
+            return self._null_timer
+        return _MetricsTimer(self, phase, site, path)
+
+    def request(self, url, seconds, nbytes, status, retries):
+        if not self.enabled:
+            return
+        host = urllib.parse.urlsplit(url).netloc
+        self.add('http', host, seconds, nbytes)
+        with self._lock:
+            stats = self.requests.setdefault(host, {
+                'count': 0, 'seconds': 0.0, 'max_seconds': 0.0, 'bytes': 0,
+                'retries': 0, 'statuses': {}})
+            stats['count'] += 1
+            stats['seconds'] += seconds
+            stats['max_seconds'] = max(stats['max_seconds'], seconds)
+            stats['bytes'] += nbytes
+            stats['retries'] += retries
+            status = str(status)
+            stats['statuses'][status] = stats['statuses'].get(status, 0) + 1
+
+    def as_json(self):
+        with self._lock:
+            return {
+                'start': self.start,
+                'wall_seconds': time.time() - self.start,
+                'phases': [{
+                    'phase': phase, 'site': site, 'count': count,
+                    'seconds': seconds, 'bytes': nbytes,
+                } for (phase, site), (count, seconds, nbytes)
+                    in self.phases.items()],
+                'requests': json.loads(json.dumps(self.requests)),
+            }
+
+    def report(self):
+        data = self.as_json()
+        lines = ['%-8s %-24s %8s %10s %12s' % (
+            'Phase', 'Site', 'Count', 'Seconds', 'Bytes')]
+        totals = collections.OrderedDict()
+        for p in sorted(data['phases'], key=lambda p: -p['seconds']):
+            lines.append('%-8s %-24s %8d %10.2f %12d' % (
+                p['phase'], p['site'] or '', p['count'], p['seconds'],
+                p['bytes']))
+            totals[p['phase']] = totals.get(p['phase'], 0) + p['seconds']
+        lines.append('')
+        lines.append('Total by phase: ' + ',  '.join(
+            '%s: %.2fs' % t for t in totals.items()))
+        for host, r in data['requests'].items():
+            lines.append(
+                '%s: %d requests, %.0f ms average, %.0f ms max, %d retries,'
+                ' statuses %s' % (
+                    host, r['count'], 1000 * r['seconds'] / r['count'],
+                    1000 * r['max_seconds'], r['retries'],
+                    ', '.join('%s: %d' % s for s in r['statuses'].items())))
+        lines.append('Wall time: %.2fs' % data['wall_seconds'])
+        return '\n'.join(lines)
+
+
+METRICS = Metrics()
+
+
+HTTPResponse = collections.namedtuple(
+    'HTTPResponse', ['url', 'status', 'headers', 'body'])
+
+
+class HTTPTransport(object):
+    """ Keep-alive HTTP(S) client with one connection pool per host.
+
+    host_overrides maps a netloc (e.g. "graph.facebook.com") to a base URL
+    (e.g. "http://127.0.0.1:8080") that requests are sent to instead, so
+    that a local fake server can stand in for the real sites.
+    """
+
+    USER_AGENT = 'fbcomments (https://github.com/hhucn/fbcomments)'
+    REDIRECT_CODES = (301, 302, 303, 307, 308)
+
+    def __init__(self, host_overrides=None, timeout=60, max_redirects=5):
+        self.host_overrides = dict(host_overrides or {})
+        self.timeout = timeout
+        self.max_redirects = max_redirects
+        self._idle = collections.defaultdict(list)
+        self._lock = threading.Lock()
+
+    def _target(self, url):
+        parsed = urllib.parse.urlsplit(url)
+        override = self.host_overrides.get(parsed.netloc)
+        if override:
+            override_parsed = urllib.parse.urlsplit(override)
+            return override_parsed.scheme, override_parsed.netloc, parsed
+        return parsed.scheme, parsed.netloc, parsed
+
+    def _get_connection(self, key):
+        with self._lock:
+            idle = self._idle[key]
+            if idle:
+                return idle.pop(), True
+        scheme, netloc = key
+        if scheme == 'https':
+            conn = http.client.HTTPSConnection(netloc, timeout=self.timeout)
+        else:
+            conn = http.client.HTTPConnection(netloc, timeout=self.timeout)
+        return conn, False
+
+    def _release_connection(self, key, conn):
+        with self._lock:
+            self._idle[key].append(conn)
+
+    def close(self):
+        with self._lock:
+            conns = list(itertools.chain(*self._idle.values()))
+            self._idle.clear()
+        for conn in conns:
+            conn.close()
+
+    def _request_once(self, url, method, body, headers):
+        scheme, netloc, parsed = self._target(url)
+        key = (scheme, netloc)
+        path = urllib.parse.urlunsplit(
+            ('', '', parsed.path or '/', parsed.query, ''))
+        all_headers = {
+            'Host': parsed.netloc,
+            'User-Agent': self.USER_AGENT,
+            'Accept-Encoding': 'gzip, deflate',
+        }
+        all_headers.update(headers)
+
+        while True:
+            conn, reused = self._get_connection(key)
+            try:
+                conn.request(method, path, body=body, headers=all_headers)
+                resp = conn.getresponse()
+                raw = resp.read()
+            except (http.client.RemoteDisconnected, ConnectionError):
+                conn.close()
+                if reused:
+                    # The server closed an idle keep-alive connection
+                    continue
+                raise
+            except Exception:
+                conn.close()
+                raise
+            break
+
+        if resp.will_close:
+            conn.close()
+        else:
+            self._release_connection(key, conn)
+
+        return HTTPResponse(
+            url, resp.status, resp.msg,
+            _decode_content(raw, resp.msg.get('Content-Encoding')))
+
+    def request(self, url, method='GET', body=None, headers={}):
+        for _ in range(self.max_redirects + 1):
+            resp = self._request_once(url, method, body, headers)
+            location = resp.headers.get('Location')
+            if resp.status not in self.REDIRECT_CODES or not location:
+                break
+            url = urllib.parse.urljoin(url, location)
+            if resp.status == 303 or (
+                    resp.status == 302 and method == 'POST'):
+                method = 'GET'
+                body = None
+
+        if resp.status >= 400:
+            error = urllib.error.HTTPError(
+                url, resp.status, http.client.responses.get(resp.status, ''),
+                resp.headers, io.BytesIO(resp.body))
+            error.body = resp.body
+            raise error
+        return resp
+
+
+def _decode_content(raw, content_encoding):
+    content_encoding = (content_encoding or '').strip().lower()
+    if content_encoding in ('gzip', 'x-gzip'):
+        return gzip.decompress(raw)
+    if content_encoding == 'deflate':
+        try:
+            return zlib.decompress(raw)
+        except zlib.error:
+            # Some servers send raw deflate data without a zlib header
+            return zlib.decompress(raw, -zlib.MAX_WBITS)
+    return raw
+
+
+class HTTPCache(object):
+    """ On-disk cache of HTTP responses, keyed by the hash of the URL.
+
+    Entries younger than ttl seconds are served directly, older ones are
+    revalidated with ETag/Last-Modified. The least recently used entries
+    are evicted once the cache grows beyond max_size bytes. In offline
+    mode, only cached responses are served.
+    """
+
+    STORED_HEADERS = ('Content-Type', 'ETag', 'Last-Modified')
+
+    def __init__(self, directory, ttl=None, max_size=None, offline=False):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_size = max_size
+        self.offline = offline
+        self._lock = threading.Lock()
+        self._size = None
+
+    def key(self, url):
+        normalized = _strip_params(url)
+        return hashlib.sha256(normalized.encode('utf-8')).hexdigest()
+
+    def _paths(self, key):
+        body_fn = os.path.join(self.directory, key[:2], key)
+        return body_fn, body_fn + '.json'
+
+    def get(self, key, url):
+        """ Returns a tuple (meta, HTTPResponse of url), or None if not
+        cached """
+        body_fn, meta_fn = self._paths(key)
+        try:
+            meta = _read_json(meta_fn)
+            with io.open(body_fn, 'rb') as bodyf:
+                body = bodyf.read()
+            os.utime(body_fn)  # Mark as recently used
+        except (IOError, OSError, ValueError):
+            # Includes entries evicted concurrently
+            return None
+        # The stored URL lacks the secrets of the requested one
+        return meta, HTTPResponse(
+            url, meta['status'], meta['headers'], body)
+
+    def is_fresh(self, meta):
+        if self.ttl is None:
+            return True
+        return time.time() - meta['fetched'] < self.ttl
+
+    def revalidation_headers(self, meta):
+        headers = {}
+        if meta['headers'].get('ETag'):
+            headers['If-None-Match'] = meta['headers']['ETag']
+        if meta['headers'].get('Last-Modified'):
+            headers['If-Modified-Since'] = meta['headers']['Last-Modified']
+        return headers
+
+    def _write_meta(self, key, meta):
+        _, meta_fn = self._paths(key)
+        tmp_fn = '%s.%d.tmp' % (meta_fn, threading.get_ident())
+        with io.open(tmp_fn, 'w', encoding='utf-8') as metaf:
+            metaf.write(json.dumps(meta))
+        os.replace(tmp_fn, meta_fn)
+
+    def refresh(self, key, meta):
+        meta = dict(meta, fetched=time.time())
+        self._write_meta(key, meta)
+
+    def put(self, key, resp):
+        body_fn, _ = self._paths(key)
+        os.makedirs(os.path.dirname(body_fn), exist_ok=True)
+        meta = {
+            'url': _strip_params(resp.url),
+            'status': resp.status,
+            'headers': {
+                h: resp.headers.get(h) for h in self.STORED_HEADERS
+                if resp.headers.get(h)},
+            'fetched': time.time(),
+        }
+        tmp_fn = '%s.%d.tmp' % (body_fn, threading.get_ident())
+        with io.open(tmp_fn, 'wb') as bodyf:
+            bodyf.write(resp.body)
+        old_size = (
+            os.path.getsize(body_fn) if os.path.exists(body_fn) else 0)
+        os.replace(tmp_fn, body_fn)
+        self._write_meta(key, meta)
+
+        with self._lock:
+            if self._size is not None:
+                self._size += len(resp.body) - old_size
+        self.evict()
+
+    def _entries(self):
+        for dirpath, _, filenames in os.walk(self.directory):
+            for fn in filenames:
+                if fn.endswith('.json') or fn.endswith('.tmp'):
+                    continue
+                path = os.path.join(dirpath, fn)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                yield st.st_mtime, st.st_size, path
+
+    def evict(self):
+        if self.max_size is None:
+            return
+        with self._lock:
+            if self._size is None:
+                self._size = sum(size for _, size, _ in self._entries())
+            if self._size <= self.max_size:
+                return
+            for _, size, path in sorted(self._entries()):
+                for fn in (path, path + '.json'):
+                    try:
+                        os.remove(fn)
+                    except OSError:
+                        pass
+                self._size -= size
+                if self._size <= self.max_size:
+                    break
+
+
+SECRET_PARAMS = ('access_token', 'api_key')
+
+
+def _strip_params(url, names=SECRET_PARAMS):
+    """ Removes secret query parameters from a URL """
+    parsed = urllib.parse.urlsplit(url)
+    query = [
+        (k, v) for k, v in urllib.parse.parse_qsl(
+            parsed.query, keep_blank_values=True)
+        if k not in names]
+    return urllib.parse.urlunsplit(
+        parsed._replace(query=urllib.parse.urlencode(query)))
+
+
+def _add_params(url, params):
+    parsed = urllib.parse.urlsplit(url)
+    query = urllib.parse.parse_qsl(parsed.query, keep_blank_values=True)
+    query.extend(params.items())
+    return urllib.parse.urlunsplit(
+        parsed._replace(query=urllib.parse.urlencode(query)))
+
+
+class Journal(object):
+    """ Append-only checkpoint journal of a snapshot directory.
+
+    Every line is a JSON object, either {"done": key} for a completed
+    download, or {"key": key, "next": cursor, "end": offset} for one page of
+    a paginated download, where cursor is whatever is needed to request the
+    following page (None after the last page). The records of the pages of
+    a key are spooled to a JSON Lines file in SPOOL_DIR, whose first offset
+    bytes belong to the journaled pages. The journal is removed once the
+    download of the snapshot is complete.
+    """
+
+    FILENAME = 'journal'
+    SPOOL_DIR = '.journal'
+
+    def __init__(self, d):
+        self.fn = os.path.join(d, self.FILENAME)
+        self.spool_dir = os.path.join(d, self.SPOOL_DIR)
+        self._lock = threading.Lock()
+        self._done = set()
+        self._pages = collections.defaultdict(list)
+        self._ends = {}
+        if os.path.exists(self.fn):
+            with io.open(self.fn, 'r', encoding='utf-8') as journalf:
+                for line in journalf:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        break  # Incomplete last line of an aborted run
+                    if 'done' in entry:
+                        self._done.add(entry['done'])
+                    else:
+                        self._pages[entry['key']].append(
+                            (entry['next'], entry['end']))
+                        self._ends[entry['key']] = entry['end']
+        self._journalf = io.open(self.fn, 'a', encoding='utf-8')
+
+    def _append(self, entry):
+        line = json.dumps(entry, ensure_ascii=False) + '\n'
+        with self._lock:
+            self._journalf.write(line)
+            self._journalf.flush()
+
+    def _spool_fn(self, key):
+        return os.path.join(self.spool_dir, hashlib.sha256(
+            key.encode('utf-8')).hexdigest() + '.jsonl')
+
+    def is_done(self, key):
+        with self._lock:
+            return key in self._done
+
+    def mark_done(self, key):
+        self._append({'done': key})
+        with self._lock:
+            self._done.add(key)
+            self._pages.pop(key, None)
+
+    def pages(self, key):
+        """ Returns a list of (next_cursor, records) tuples of the pages
+        journaled by an earlier run """
+        with self._lock:
+            pages = list(self._pages.get(key, []))
+        if not pages:
+            return []
+        res = []
+        start = 0
+        with io.open(self._spool_fn(key), 'rb') as spoolf:
+            for next_cursor, end in pages:
+                lines = spoolf.read(end - start).decode('utf-8').splitlines()
+                res.append((next_cursor, [json.loads(line) for line in lines]))
+                start = end
+        return res
+
+    def add_page(self, key, next_cursor, records):
+        content = ''.join(
+            json.dumps(r, ensure_ascii=False) + '\n' for r in records
+        ).encode('utf-8')
+        with self._lock:
+            start = self._ends.get(key, 0)
+        os.makedirs(self.spool_dir, exist_ok=True)
+        # Drops whatever an aborted run wrote after its last journaled page
+        with io.open(self._spool_fn(key), 'r+b' if start else 'wb') as spoolf:
+            spoolf.seek(start)
+            spoolf.write(content)
+            spoolf.truncate()
+        end = start + len(content)
+        with self._lock:
+            self._ends[key] = end
+        self._append({'key': key, 'next': next_cursor, 'end': end})
+
+    def close(self):
+        self._journalf.close()
+
+    def remove(self):
+        """ Closes and deletes the journal and its spooled records """
+        self.close()
+        os.remove(self.fn)
+        shutil.rmtree(self.spool_dir, ignore_errors=True)
+
+
+class Manifest(object):
+    """ Sidecar of a snapshot directory with the record counts, sizes and
+    checksums of its data files and the fetch times of its URLs, so that
+    statistics and integrity checks do not need to parse the data.
+
+    files maps the name of every data file (see _base_name) to a dict with
+    the keys file, kind (feed, post, comments, likes or article), post_id,
+    records, comments, replies, likes, bytes and sha256.
+    """
+
+    FILENAME = 'manifest.json'
+
+    def __init__(self, d):
+        self.d = d
+        self.fn = os.path.join(d, self.FILENAME)
+        self._lock = threading.Lock()
+        data = {}
+        if os.path.exists(self.fn):
+            data = _read_json(self.fn)
+        self.created = data.get('created', time.time())
+        self.complete = data.get('complete', False)
+        self.files = data.get('files', {})
+        self.urls = data.get('urls', {})
+        self.users = data.get('users')
+
+    @staticmethod
+    def load(d):
+        """ Returns the Manifest of d, or None if it has none """
+        if not os.path.exists(os.path.join(d, Manifest.FILENAME)):
+            return None
+        return Manifest(d)
+
+    def add_file(self, name, fn, records=None, comments=None, replies=0):
+        kind, _, post_id = name.partition('_')
+        if kind not in ('feed', 'post', 'comments', 'likes'):
+            kind, post_id = 'article', None
+        if kind == 'comments':
+            comments = records
+        entry = {
+            'file': os.path.basename(fn),
+            'kind': kind,
+            'post_id': post_id or None,
+            'records': records,
+            'comments': comments or 0,
+            'replies': replies,
+            'likes': records if kind == 'likes' else 0,
+            'bytes': os.path.getsize(fn),
+            'sha256': _file_sha256(fn),
+        }
+        with self._lock:
+            self.files[name] = entry
+
+    def add_url(self, url, seconds, ok):
+        with self._lock:
+            self.urls[url] = {'seconds': seconds, 'ok': ok}
+
+    def totals(self):
+        with self._lock:
+            files = list(self.files.values())
+        return {
+            'files': len(files),
+            'bytes': sum(f['bytes'] for f in files),
+            'posts': sum(1 for f in files if f['kind'] in ('post', 'article')),
+            'graph_comments': sum(
+                f['comments'] for f in files if f['kind'] == 'comments'),
+            'comments': sum(f['comments'] for f in files),
+            'replies': sum(f['replies'] for f in files),
+            'likes': sum(f['likes'] for f in files),
+        }
+
+    def add_unlisted_files(self):
+        """ Adds the data files of the snapshot which are not listed yet.
+        Returns their number. """
+        with self._lock:
+            listed = {entry['file'] for entry in self.files.values()}
+        added = 0
+        for fn in _snapshot_data_files(self.d):
+            if fn not in listed:
+                self.add_file(
+                    _base_name(fn), os.path.join(self.d, fn),
+                    **_manifest_counts(_load_data(self.d, fn)))
+                added += 1
+        return added
+
+    def save(self):
+        # Copies, as jobs may add files while the manifest is written
+        with self._lock:
+            data = {
+                'created': self.created,
+                'complete': self.complete,
+                'totals': None,
+                'users': self.users,
+                'urls': dict(self.urls),
+                'files': dict(self.files),
+            }
+        data['totals'] = self.totals()
+        _write_json_atomic(self.fn, data)
+        return data
+
+
+def _file_sha256(fn):
+    h = hashlib.sha256()
+    with open(fn, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _write_json_atomic(fn, data):
+    tmp_fn = '%s.%d.tmp' % (fn, os.getpid())
+    with io.open(tmp_fn, 'w', encoding='utf-8') as f:
+        json.dump(data, f, indent=2, ensure_ascii=False, sort_keys=True)
+    os.replace(tmp_fn, fn)
+
+
+class TokenBucket(object):
+    """ Thread-safe token bucket allowing rate requests per second.
+
+    A rate of None means unlimited. throttle() temporarily reduces the
+    rate to a fraction of it, pause() blocks all requests for a while.
+    """
+
+    def __init__(self, rate=None, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.factor = 1.0
+        self._tokens = burst
+        self._last = time.monotonic()
+        self._paused_until = 0
+        self._lock = threading.Lock()
+
+    def throttle(self, factor):
+        with self._lock:
+            self.factor = factor
+
+    def pause(self, seconds):
+        with self._lock:
+            self._paused_until = max(
+                self._paused_until, time.monotonic() + seconds)
+
+    def _effective_rate(self):
+        if self.rate is None:
+            # Unlimited, unless throttled
+            return None if self.factor >= 1 else 10 * self.factor
+        return self.rate * self.factor
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                wait = self._paused_until - now
+                rate = self._effective_rate()
+                if wait <= 0 and rate is None:
+                    return
+                if wait <= 0:
+                    self._tokens = min(
+                        self.burst, self._tokens + (now - self._last) * rate)
+                    self._last = now
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        return
+                    wait = (1 - self._tokens) / rate
+            time.sleep(wait)
+
+
+class RequestScheduler(object):
+    """ Rate limits requests per host and retries failed ones.
+
+    Requests failing with 429, 5xx, timeouts, connection errors or a Graph
+    API throttling error are retried with exponential backoff and full
+    jitter. Graph API usage headers (and Disqus rate limit headers) are
+    used to slow down once usage_threshold percent of the quota are used.
+    """
+
+    RETRY_STATUSES = (429, 500, 502, 503, 504)
+    # See https://developers.facebook.com/docs/graph-api/advanced/rate-limiting
+    GRAPH_THROTTLE_CODES = (4, 17, 32, 613)
+    USAGE_HEADERS = (
+        'X-App-Usage', 'X-Page-Usage', 'X-Business-Use-Case-Usage')
+
+    def __init__(self, rate_limits=None, max_retries=5, backoff=1.0,
+                 backoff_max=60.0, usage_threshold=75):
+        self.rate_limits = dict(rate_limits or {})
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.usage_threshold = usage_threshold
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def bucket(self, url):
+        host = urllib.parse.urlsplit(url).netloc
+        with self._lock:
+            bucket = self._buckets.get(host)
+            if bucket is None:
+                bucket = TokenBucket(self.rate_limits.get(host))
+                self._buckets[host] = bucket
+            return bucket
+
+    def _is_retryable(self, he):
+        if he.code in self.RETRY_STATUSES:
+            return True
+        try:
+            error = json.loads(getattr(he, 'body', b'').decode('utf-8'))
+            return error['error']['code'] in self.GRAPH_THROTTLE_CODES
+        except (ValueError, KeyError, TypeError, UnicodeDecodeError):
+            return False
+
+    def _backoff_time(self, attempt, retry_after=None):
+        if retry_after:
+            try:
+                return min(float(retry_after), self.backoff_max)
+            except ValueError:
+                pass
+        return random.uniform(
+            0, min(self.backoff_max, self.backoff * 2 ** attempt))
+
+    def _usage(self, headers):
+        """ Returns a tuple (percentage of quota used, seconds until the
+        quota is regained) """
+        usage = 0
+        regain = 0
+        for header in self.USAGE_HEADERS:
+            value = headers.get(header)
+            if not value:
+                continue
+            try:
+                data = json.loads(value)
+            except ValueError:
+                continue
+            if header == 'X-Business-Use-Case-Usage':
+                entries = itertools.chain(*data.values())
+            else:
+                entries = [data]
+            for entry in entries:
+                usage = max(usage, entry.get('call_count', 0),
+                            entry.get('total_time', 0),
+                            entry.get('total_cputime', 0))
+                regain = max(regain, 60 * entry.get(
+                    'estimated_time_to_regain_access', 0))
+
+        limit = headers.get('X-Ratelimit-Limit')
+        remaining = headers.get('X-Ratelimit-Remaining')
+        if limit and remaining:
+            try:
+                usage = max(
+                    usage, 100 - 100 * int(remaining) // max(1, int(limit)))
+                if int(remaining) == 0:
+                    reset = headers.get('X-Ratelimit-Reset')
+                    regain = max(regain, int(reset) - time.time())
+            except (ValueError, TypeError):
+                pass
+        return usage, regain
+
+    def _observe(self, bucket, headers):
+        usage, regain = self._usage(headers)
+        if regain > 0:
+            bucket.pause(regain)
+        if usage > self.usage_threshold:
+            bucket.throttle(max(
+                0.05, (100 - usage) / (100 - self.usage_threshold)))
+        else:
+            bucket.throttle(1.0)
+
+    def request(self, url, func):
+        """ Calls func() (which requests url) under the rate limit of url's
+        host, and retries it if it fails with a transient error """
+        bucket = self.bucket(url)
+        seconds = 0.0
+        status = None
+        nbytes = 0
+        attempt = 0
+        try:
+            for attempt in itertools.count():
+                bucket.acquire()
+                start = time.monotonic()
+                try:
+                    resp = func()
+                except urllib.error.HTTPError as he:
+                    seconds += time.monotonic() - start
+                    status = he.code
+                    if (attempt >= self.max_retries or
+                            not self._is_retryable(he)):
+                        raise
+                    self._observe(bucket, he.headers)
+                    delay = self._backoff_time(
+                        attempt, he.headers.get('Retry-After'))
+                    bucket.pause(delay)
+                    continue
+                except (OSError, http.client.HTTPException) as e:
+                    seconds += time.monotonic() - start
+                    status = type(e).__name__
+                    if attempt >= self.max_retries:
+                        raise
+                    time.sleep(self._backoff_time(attempt))
+                    continue
+                seconds += time.monotonic() - start
+                status = resp.status
+                nbytes = len(resp.body)
+                self._observe(bucket, resp.headers)
+                return resp
+        finally:
+            METRICS.request(url, seconds, nbytes, status, attempt)
+
+
+_config_lock = threading.Lock()
+
+
+def _config_object(config, key, factory):
+    """ Returns config[key], creating it with factory() on first use """
+    with _config_lock:
+        obj = config.get(key)
+        if obj is None:
+            obj = factory()
+            config[key] = obj
+        return obj
+
+
+def _http(config):
+    """ Returns the HTTPTransport of this configuration.
+
+    Tests can inject their own transport by setting config['_http'].
+    """
+    return _config_object(config, '_http', lambda: HTTPTransport(
+        host_overrides=config.get('http_host_overrides'),
+        timeout=config.get('http_timeout', 60)))
+
+
+def _scheduler(config):
+    """ Returns the RequestScheduler of this configuration """
+    return _config_object(config, '_scheduler', lambda: RequestScheduler(
+        rate_limits=_rate_limits(config),
+        max_retries=config.get('max_retries', 5),
+        backoff=config.get('retry_backoff', 1.0),
+        backoff_max=config.get('retry_backoff_max', 60.0),
+        usage_threshold=config.get('usage_threshold', 75)))
+
+
+def _cache(config):
+    """ Returns the HTTPCache of this configuration, or None """
+    if not config.get('cache'):
+        return None
+    return _config_object(config, '_cache', lambda: HTTPCache(
+        os.path.join(config['download_location'], '.cache'),
+        ttl=config.get('cache_ttl'),
+        max_size=config.get('cache_max_size'),
+        offline=config.get('cache_offline', False)))
+
+
+def _fetch(config, url):
+    """ GET url, going through the response cache if it is enabled """
+    cache = _cache(config)
+    if cache is None:
+        return _scheduler(config).request(
+            url, lambda: _http(config).request(url))
+
+    key = cache.key(url)
+    cached = cache.get(key, url)
+    if cached:
+        meta, cached_resp = cached
+        if cache.offline or cache.is_fresh(meta):
+            METRICS.add(
+                'cache', urllib.parse.urlsplit(url).netloc, 0.0,
+                len(cached_resp.body))
+            return cached_resp
+    elif cache.offline:
+        raise urllib.error.URLError('%s is not cached (offline mode)' % url)
+
+    headers = cache.revalidation_headers(meta) if cached else {}
+    resp = _scheduler(config).request(
+        url, lambda: _http(config).request(url, headers=headers))
+    if cached and resp.status == 304:
+        cache.refresh(key, meta)
+        return cached_resp
+    if resp.status == 200:
+        cache.put(key, resp)
+    return resp
+
+
+def _graph_url(config, path, params):
     url = 'https://graph.facebook.com/v2.2/%s' % path
     if config.get('verbose'):
         print(url)
+    params = dict(params)
     params.update({
         'access_token': config['access_token'],
         'limit': '200',
     })
-    full_url = url + '?' + urllib.parse.urlencode(params)
+    return url + '?' + urllib.parse.urlencode(params)
+
+
+def graph_api(config, path, params={}, filter_func=None):
+    """ Returns the list of all records of a paginated Graph API response,
+    or the response itself if it is not paginated. """
     data = []
-    while True:
-        with urllib.request.urlopen(full_url) as req:
-            b = req.read()
-        d = json.loads(b.decode('utf-8'))
-        if 'data' not in d:
-            assert not data
-            return d
-        this_page = filter(filter_func, d['data'])
-        data.extend(this_page)
-        if 'paging' in d and 'next' in d['paging']:
-            full_url = d['paging']['next']
-        else:
-            break
+    for page in graph_api_pages(config, path, params, filter_func):
+        if isinstance(page, dict):
+            return page
+        data.extend(page)
     return data
 
 
-def _download_webpage(url):
-    with urllib.request.urlopen(url) as req:
-        b = req.read()
-        content_type = req.headers.get('Content-Type')
-        encoding = 'utf-8'
-        if content_type:
-            content_type_charset_m = re.search(
-                r';\s*charset=(UTF-?8|ISO-[0-9]+-[0-9]+)', content_type)
-            if content_type_charset_m:
-                encoding = content_type_charset_m.group(1)
-        return b.decode(encoding)
+def graph_api_pages(config, path, params={}, filter_func=None):
+    """ Yields the (filtered) records of a paginated Graph API response one
+    page at a time, as soon as each page arrives. A response which is not
+    paginated is yielded as it is. """
+    return _graph_pages(
+        config, _graph_url(config, path, params), filter_func)
+
+
+def _graph_pages(config, full_url, filter_func=None):
+    journal = config.get('_journal')
+    journal_key = 'graph:' + _strip_params(full_url)
+    if journal:
+        for next_url, records in journal.pages(journal_key):
+            yield records
+            full_url = next_url and _add_params(
+                next_url, {'access_token': config['access_token']})
+
+    first = True
+    while full_url:
+        b = _fetch(config, full_url).body
+        with METRICS.timer('parse', 'graph.facebook.com'):
+            d = json.loads(b.decode('utf-8'))
+        if 'data' not in d:
+            assert first
+            yield d
+            return
+        first = False
+        this_page = list(filter(filter_func, d['data']))
+        full_url = d.get('paging', {}).get('next')
+        if journal:
+            journal.add_page(
+                journal_key, full_url and _strip_params(full_url), this_page)
+        yield this_page
+
+
+GRAPH_BATCH_SIZE = 50
+
+GRAPH_POST_FIELDS = (
+    'id,from,to,message,name,caption,description,link,picture,type,'
+    'status_type,created_time,updated_time,shares')
+GRAPH_COMMENT_FIELDS = 'parent,id,message,created_time,from,like_count'
+
+
+def _graph_post_fields(with_comments=True):
+    """ Field expansion which requests a post together with the first pages
+    of its comments and likes """
+    fields = GRAPH_POST_FIELDS + ',likes.limit(200)'
+    if with_comments:
+        fields += ',comments.filter(stream).limit(200){%s}' % (
+            GRAPH_COMMENT_FIELDS)
+    return fields
+
+
+def graph_batch(config, paths):
+    """ Requests many Graph API paths with as few HTTP requests as possible.
+
+    Returns a list of the responses (or None for failed sub-requests), in
+    the order of paths. """
+    res = []
+    for i in range(0, len(paths), GRAPH_BATCH_SIZE):
+        # Sorted, so that the same posts make the same cached batch
+        batch_paths = sorted(set(paths[i:i + GRAPH_BATCH_SIZE]))
+        items = dict(zip(batch_paths, _fetch_batch(config, batch_paths)))
+        res.extend(items[path] for path in paths[i:i + GRAPH_BATCH_SIZE])
+    return res
+
+
+def _fetch_batch(config, paths):
+    """ POSTs one Graph batch request, going through the response cache if
+    it is enabled. Batches are cached under the URLs of their sub-requests,
+    are not revalidated, and are only stored if all sub-requests
+    succeeded. """
+    url = 'https://graph.facebook.com/'
+    batch = [
+        {'method': 'GET', 'relative_url': 'v2.2/%s' % path}
+        for path in paths]
+    cache = _cache(config)
+    if cache is not None:
+        key = cache.key(_add_params(url, {
+            'batch': json.dumps([r['relative_url'] for r in batch])}))
+        cached = cache.get(key, url)
+        if cached and (cache.offline or cache.is_fresh(cached[0])):
+            METRICS.add(
+                'cache', 'graph.facebook.com', 0.0, len(cached[1].body))
+            return _parse_batch(cached[1])
+        if cache.offline:
+            raise urllib.error.URLError(
+                'Batch of %s is not cached (offline mode)' % ', '.join(paths))
+
+    if config.get('verbose'):
+        print('%s (batch of %d)' % (url, len(batch)))
+    body = urllib.parse.urlencode({
+        'access_token': config['access_token'],
+        'batch': json.dumps(batch),
+    }).encode('ascii')
+    resp = _scheduler(config).request(url, lambda: _http(config).request(
+        url, method='POST', body=body, headers={
+            'Content-Type': 'application/x-www-form-urlencoded'}))
+    res = _parse_batch(resp)
+    if cache is not None and None not in res:
+        cache.put(key, resp)
+    return res
+
+
+def _parse_batch(resp):
+    res = []
+    with METRICS.timer('parse', 'graph.facebook.com'):
+        for item in json.loads(resp.body.decode('utf-8')):
+            # Sub-requests which timed out are null
+            if item is None or item.get('code') != 200:
+                res.append(None)
+            else:
+                res.append(json.loads(item['body']))
+    return res
+
+
+def _graph_edge(config, obj, edge):
+    """ Yields all records of an expanded edge of obj, following its inner
+    paging where necessary """
+    if edge not in obj:
+        return
+    yield from obj[edge].get('data', [])
+    next_url = obj[edge].get('paging', {}).get('next')
+    if next_url:
+        for page in _graph_pages(config, next_url):
+            yield from page
+
+
+def _download_webpage(config, url):
+    resp = _fetch(config, url)
+    content_type = resp.headers.get('Content-Type')
+    encoding = 'utf-8'
+    if content_type:
+        content_type_charset_m = re.search(
+            r';\s*charset=(UTF-?8|ISO-[0-9]+-[0-9]+)', content_type)
+        if content_type_charset_m:
+            encoding = content_type_charset_m.group(1)
+    return resp.body.decode(encoding)
+
+
+def _download_pages(config, urls, parse_func):
+    """ Downloads all urls concurrently and returns parse_func(webpage) of
+    each of them in order. The parsed pages are checkpointed in the
+    journal. """
+    page_count = len(urls)
+    journal = config.get('_journal')
+
+    def _download_page(t):
+        page, url = t
+        journal_key = 'page:' + url
+        if journal:
+            for _, records in journal.pages(journal_key):
+                return records
+        if config.get('verbose'):
+            print('.. %d/%d' % (page, page_count))
+        webpage = _download_webpage(config, url)
+        with METRICS.timer('parse', urllib.parse.urlsplit(url).netloc):
+            records = parse_func(webpage)
+        if journal:
+            journal.add_page(journal_key, None, records)
+        return records
+
+    # The calling download job holds one slot of the host already. Further
+    # pages are only fetched concurrently while the host has free slots.
+    limiter = urls and _host_limiter(config, urllib.parse.urlsplit(
+        urls[0]).netloc)
+    workers = 1
+    if limiter:
+        while (workers < config.get('page_workers', 4) and
+                limiter.acquire(blocking=False)):
+            workers += 1
+    else:
+        workers = config.get('page_workers', 4)
+    try:
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=workers) as executor:
+            return list(executor.map(
+                _download_page, enumerate(urls, start=1)))
+    finally:
+        if limiter:
+            for _ in range(workers - 1):
+                limiter.release()
+
 
+_POST_NAME_SCHEME_RE = re.compile(r'^https?://')
+_POST_NAME_CHARS_RE = re.compile(r'[^A-Za-z0-9-]+')
 
-def _write_post(d, url, post):
+
+@functools.lru_cache(maxsize=65536)
+def _post_name(url):
     assert url.startswith('http')
 
-    bname = os.path.basename(
-        re.sub(r'[^A-Za-z0-9-]+', '_', re.sub(r'^https?://', '', url)))
-    _write_data(d, bname, post)
+    return os.path.basename(_POST_NAME_CHARS_RE.sub(
+        '_', _POST_NAME_SCHEME_RE.sub('', url)))
+
+
+def _write_post(config, d, url, post):
+    _write_data(config, d, _post_name(url), post)
 
 
 def _load_post(d, url):
-    assert url.startswith('http')
+    return _load_data(d, _post_name(url))
+
+
+# Suffixes of the compressed storage formats. Lists are stored as JSON Lines
+# (name.jsonl.gz), everything else as compact JSON (name.json.gz).
+STORAGE_SUFFIXES = {
+    'json': '',
+    'gzip': '.gz',
+    'zstd': '.zst',
+}
+# Files in a snapshot directory which do not hold downloaded data
+SNAPSHOT_META_FILES = {Journal.FILENAME, Manifest.FILENAME, 'timeseries.json'}
+
+
+def _data_fn(config, d, name, data_is_list):
+    if config.get('dedup'):
+        return os.path.join(d, name + DEDUP_REF_SUFFIX)
+    return _storage_fn(config, d, name, data_is_list)
+
+
+def _storage_fn(config, d, name, data_is_list):
+    suffix = STORAGE_SUFFIXES[config.get('storage_format', 'json')]
+    if suffix:
+        name += ('.jsonl' if data_is_list else '.json') + suffix
+    return os.path.join(d, name)
+
+
+def _data_path(d, name):
+    """ Returns the file name of stored data in any format, or None """
+    for fn in [name, name + DEDUP_REF_SUFFIX] + [
+            name + ext + suffix
+            for suffix in STORAGE_SUFFIXES.values() if suffix
+            for ext in ('.jsonl', '.json')]:
+        path = os.path.join(d, fn)
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def _base_name(fn):
+    """ Returns the name under which the data file fn is stored """
+    return re.sub(r'(?:\.jsonl?\.(?:gz|zst)|\.ref)$', '', fn)
+
+
+# With the dedup option, data is stored once in a content-addressed object
+# store (objects/ in the download location), and snapshots only contain
+# name.ref files with the hashes of its objects: {"list": bool, "objects":
+# [...]}. Lists are split into chunks of records, whose boundaries depend on
+# the records only: a chunk ends after every record whose checksum is
+# divisible by the average chunk size. Records inserted anywhere in a list,
+# such as the newest comments at the front, thus only change the chunk they
+# are inserted into. The comments of a post are stored the same way, in
+# "comments".
+DEDUP_OBJECTS = 'objects'
+DEDUP_REF_SUFFIX = '.ref'
+DEDUP_CHUNK_SIZE = 1000
+
+
+def _objects_dir(d):
+    return os.path.join(os.path.dirname(os.path.normpath(d)), DEDUP_OBJECTS)
+
+
+def _object_dir(objects_dir, object_hash):
+    return os.path.join(objects_dir, object_hash[:2])
+
+
+def _store_object(config, d, content, is_list):
+    """ Stores content (a str) unless it is stored already, and returns its
+    hash """
+    object_hash = hashlib.sha256(content.encode('utf-8')).hexdigest()
+    obj_dir = _object_dir(_objects_dir(d), object_hash)
+    if _data_path(obj_dir, object_hash) is not None:
+        return object_hash
+    os.makedirs(obj_dir, exist_ok=True)
+    fn = _storage_fn(config, obj_dir, object_hash, is_list)
+    tmp_fn = _data_tmp_fn(fn)
+    with _open_data(tmp_fn, 'w') as objf:
+        objf.write(content)
+    os.replace(tmp_fn, fn)
+    return object_hash
+
+
+def _store_chunks(config, d, records):
+    """ Stores records in content-defined chunks of JSON Lines. Returns a
+    tuple (list of object hashes, record count, reply count). """
+    chunk_size = config.get('dedup_chunk_size', DEDUP_CHUNK_SIZE)
+    objects = []
+    chunk = []
+    count = replies = 0
+    for count, record in enumerate(records, start=1):
+        line = json.dumps(record, ensure_ascii=False, sort_keys=True)
+        chunk.append(line)
+        if isinstance(record, dict) and record.get('parent'):
+            replies += 1
+        if zlib.crc32(line.encode('utf-8')) % chunk_size == 0:
+            objects.append(
+                _store_object(config, d, '\n'.join(chunk) + '\n', True))
+            chunk = []
+    if chunk:
+        objects.append(
+            _store_object(config, d, '\n'.join(chunk) + '\n', True))
+    return objects, count, replies
+
+
+def _store_data(config, d, fn, data):
+    # Writes the ref file fn of data
+    if isinstance(data, list):
+        objects, _, _ = _store_chunks(config, d, data)
+        ref = {'list': True, 'objects': objects}
+    elif isinstance(data, dict) and isinstance(data.get('comments'), list):
+        body = dict(data, comments=[])
+        ref = {
+            'list': False,
+            'objects': [_store_object(config, d, json.dumps(
+                body, ensure_ascii=False, sort_keys=True), False)],
+            'comments': _store_chunks(config, d, data['comments'])[0],
+        }
+    else:
+        ref = {
+            'list': False,
+            'objects': [_store_object(config, d, json.dumps(
+                data, ensure_ascii=False, sort_keys=True), False)],
+        }
+    _write_json_atomic(fn, ref)
+
+
+def _load_object(objects_dir, object_hash, is_list):
+    fn = _data_path(_object_dir(objects_dir, object_hash), object_hash)
+    if fn is None:
+        raise IOError('Object %s is missing from %s' % (
+            object_hash, objects_dir))
+    with _open_data(fn, 'r') as objf:
+        if is_list:
+            return [json.loads(line) for line in objf if line.strip()]
+        return json.load(objf)
+
+
+def _load_ref(d, ref):
+    objects_dir = _objects_dir(d)
+    if ref['list']:
+        return list(itertools.chain.from_iterable(
+            _load_object(objects_dir, h, True) for h in ref['objects']))
+    data = _load_object(objects_dir, ref['objects'][0], False)
+    if 'comments' in ref:
+        data['comments'] = list(itertools.chain.from_iterable(
+            _load_object(objects_dir, h, True) for h in ref['comments']))
+    return data
+
+
+def _ref_objects(ref):
+    return ref['objects'] + ref.get('comments', [])
 
-    bname = os.path.basename(
-        re.sub(r'[^A-Za-z0-9-]+', '_', re.sub(r'^https?://', '', url)))
-    return _load_data(d, bname)
 
+def _open_data(fn, mode):
+    if fn.endswith('.gz'):
+        return gzip.open(fn, mode + 't', encoding='utf-8')
+    if fn.endswith('.zst'):
+        import zstandard
+        return zstandard.open(fn, mode + 't', encoding='utf-8')
+    return io.open(fn, mode, encoding='utf-8')
 
-def _write_data(d, name, data):
-    fn = os.path.join(d, name)
-    with io.open(fn, 'w', encoding='utf-8') as dataf:
-        dataf.write(json.dumps(data, indent=2, ensure_ascii=False))
+
+def _data_tmp_fn(fn):
+    """ Returns a temporary name under which fn can be written before it is
+    renamed. It keeps the suffix, which determines the compression, and
+    starts with a dot, so that it is never taken for a data file. """
+    return os.path.join(os.path.dirname(fn), '.%d.%d.%s' % (
+        os.getpid(), threading.get_ident(), os.path.basename(fn)))
+
+
+def _replace_data(tmp_fn, fn, success):
+    if success:
+        os.replace(tmp_fn, fn)
+    elif os.path.exists(tmp_fn):
+        os.remove(tmp_fn)
+
+
+def _write_data(config, d, name, data):
+    if isinstance(data, list):
+        _write_records(config, d, name, data)
+        return
+    fn = _data_fn(config, d, name, False)
+    if config.get('dedup'):
+        with METRICS.timer('write', 'snapshot', path=fn):
+            _store_data(config, d, fn, data)
+        _add_to_manifest(config, d, name, fn, data)
+        return
+    tmp_fn = _data_tmp_fn(fn)
+    success = False
+    try:
+        with METRICS.timer('write', 'snapshot', path=fn), \
+                _open_data(tmp_fn, 'w') as dataf:
+            if fn == os.path.join(d, name):
+                json.dump(data, dataf, indent=2, ensure_ascii=False)
+            else:
+                # Compressed formats are meant for machines only
+                json.dump(
+                    data, dataf, ensure_ascii=False, separators=(',', ':'))
+        success = True
+    finally:
+        _replace_data(tmp_fn, fn, success)
+    _add_to_manifest(config, d, name, fn, data)
+
+
+def _write_records(config, d, name, records):
+    """ Writes an iterable of records with one record per line, without
+    holding the list in memory. Returns the number of records. """
+    fn = _data_fn(config, d, name, True)
+    count = 0
+    if config.get('dedup'):
+        with METRICS.timer('write', 'snapshot', path=fn) as timer:
+            objects, count, replies = _store_chunks(
+                config, d, timer.exclude(records))
+            _write_json_atomic(fn, {'list': True, 'objects': objects})
+        manifest = _current_manifest(config, d)
+        if manifest:
+            manifest.add_file(name, fn, records=count, replies=replies)
+        return count
+    # records may be downloaded while they are written, and fail halfway,
+    # so that only complete files get their final name
+    tmp_fn = _data_tmp_fn(fn)
+    success = False
+    try:
+        with METRICS.timer('write', 'snapshot', path=fn) as timer, \
+                _open_data(tmp_fn, 'w') as dataf:
+            records = timer.exclude(records)
+            replies = 0
+            jsonl = '.jsonl' in os.path.basename(fn)
+            if not jsonl:
+                # Plain JSON list
+                dataf.write('[')
+            for count, record in enumerate(records, start=1):
+                if not jsonl:
+                    dataf.write('\n' if count == 1 else ',\n')
+                dataf.write(json.dumps(record, ensure_ascii=False))
+                if jsonl:
+                    dataf.write('\n')
+                if isinstance(record, dict) and record.get('parent'):
+                    replies += 1
+            if not jsonl:
+                dataf.write('\n]\n')
+        success = True
+    finally:
+        _replace_data(tmp_fn, fn, success)
+    manifest = _current_manifest(config, d)
+    if manifest:
+        manifest.add_file(name, fn, records=count, replies=replies)
+    return count
+
+
+def _current_manifest(config, d):
+    # The Manifest of d if it is being written, else None
+    manifest = config.get('_manifest')
+    return manifest if manifest is not None and manifest.d == d else None
+
+
+def _add_to_manifest(config, d, name, fn, data):
+    manifest = _current_manifest(config, d)
+    if manifest:
+        manifest.add_file(name, fn, **_manifest_counts(data))
+
+
+def _manifest_counts(data):
+    """ Returns the counts of Manifest.add_file for stored data """
+    if isinstance(data, list):
+        return {
+            'records': len(data),
+            'replies': sum(
+                1 for r in data if isinstance(r, dict) and r.get('parent')),
+        }
+    comments = replies = 0
+    if isinstance(data, dict) and isinstance(data.get('comments'), list):
+        # A downloaded article or post with its comment tree
+        for depth, _ in _iterate_comment_tree(data['comments']):
+            comments += 1
+            if depth:
+                replies += 1
+    return {'comments': comments, 'replies': replies}
 
 
 def _load_data(d, name):
-    fn = os.path.join(d, name)
-    with io.open(fn, 'r', encoding='utf-8') as dataf:
+    fn = _data_path(d, name)
+    if fn is None:
+        raise IOError('No data %s in %s' % (name, d))
+    if fn.endswith(DEDUP_REF_SUFFIX):
+        with METRICS.timer('read', 'snapshot', path=fn):
+            return _load_ref(d, _read_json(fn))
+    with METRICS.timer('read', 'snapshot', path=fn), \
+            _open_data(fn, 'r') as dataf:
+        if '.jsonl' in os.path.basename(fn):
+            return [json.loads(line) for line in dataf if line.strip()]
         return json.load(dataf)
 
 
+def _has_data(d, name):
+    """ Returns whether the snapshot d (which may be None) contains name """
+    return d is not None and _data_path(d, name) is not None
+
+
+def _load_optional(d, name):
+    """ Returns the data of a snapshot, or None if not present """
+    if not _has_data(d, name):
+        return None
+    return _load_data(d, name)
+
+
+def _snapshots(config):
+    """ Returns the sorted names of all snapshot directories """
+    if not os.path.exists(config['download_location']):
+        return []
+    return sorted(
+        fn for fn in os.listdir(config['download_location'])
+        if re.match(r'^[0-9]{4}-[0-9]{2}-[0-9]{2}T', fn))
+
+
+def _snapshot_complete(config, snapshot):
+    """ Returns whether the download of snapshot finished without errors.
+    Snapshots from before manifests were written (whose manifest, if any,
+    has complete set to None) are taken as complete. """
+    manifest = Manifest.load(
+        os.path.join(config['download_location'], snapshot))
+    return manifest is None or manifest.complete is not False
+
+
+def _latest_complete(snapshots, config):
+    # The last of the sorted snapshots which is complete, or None
+    return next((
+        snapshot for snapshot in reversed(snapshots)
+        if _snapshot_complete(config, snapshot)), None)
+
+
+SNAPSHOT_INDEX = 'index.json'
+
+
+def _load_index(config):
+    fn = os.path.join(config['download_location'], SNAPSHOT_INDEX)
+    if not os.path.exists(fn):
+        return None
+    return _read_json(fn)
+
+
+def _update_index(config, snapshot, manifest_data):
+    """ Records the summary of a snapshot's manifest in the index of all
+    snapshots in the download location """
+    index = _load_index(config) or {'snapshots': {}}
+    index['snapshots'][snapshot] = {
+        k: manifest_data[k] for k in ('created', 'complete', 'totals')}
+    # Reports read the latest complete snapshot, not a failed download
+    index['latest'] = max((
+        name for name, summary in index['snapshots'].items()
+        if summary['complete'] is not False), default=None)
+    _write_json_atomic(
+        os.path.join(config['download_location'], SNAPSHOT_INDEX), index)
+
+
 def _latest_data(config):
-    return sorted(os.listdir(config['download_location']))[-1]
+    # The index saves listing the download location. Snapshots are only
+    # indexed once their download has finished, and the latest one is only
+    # used if its download was complete.
+    index = _load_index(config)
+    if index and index['latest'] and os.path.isdir(
+            os.path.join(config['download_location'], index['latest'])):
+        return index['latest']
+    return _snapshots(config)[-1]
+
+
+# Comment trees are lists of comment dicts, with the replies of each comment
+# in its 'comments' list. This is also how they are stored.
+
+def _walk_comment_tree(comments):
+    """ Yields (depth, parent, comment) tuples in pre-order, where parent is
+    None for top-level comments """
+    stack = [(None, iter(comments))]
+    while stack:
+        parent, it = stack[-1]
+        for c in it:
+            yield len(stack) - 1, parent, c
+            children = c.get('comments')
+            if children:
+                stack.append((c, iter(children)))
+                break
+        else:
+            stack.pop()
 
 
-def _node_text(etree_node):
-    return (
-        ('' if etree_node.text is None else etree_node.text) +
-        ''.join(_node_text(c) for c in etree_node.getchildren()) +
-        ('' if etree_node.tail is None else etree_node.tail))
+def _iterate_comment_tree(comments):
+    # Yields (depth, comment) tuples
+    for depth, _, c in _walk_comment_tree(comments):
+        yield depth, c
+
+
+def _build_comment_tree(records):
+    """ Builds a comment tree from (comment, parent id) tuples, in any order.
+    Comments whose parent is unknown end up at the top level. """
+    records = list(records)
+    by_id = {}
+    for c, _ in records:
+        c['comments'] = []
+        if c.get('id') is not None:
+            by_id[c['id']] = c
+    roots = []
+    for c, parent_id in records:
+        parent = by_id.get(parent_id) if parent_id is not None else None
+        (roots if parent is None else parent['comments']).append(c)
+    return roots
+
+
+def _graph_comment_records(raw_comments):
+    # Yields (comment, parent id) tuples of Graph API comments
+    for rc in raw_comments:
+        yield rc, (rc['parent']['id'] if rc.get('parent') else None)
 
 
-def _read_all(d):
-    feed_index = _load_data(d, 'feed')
-    feed = []
-    for post_overview in feed_index:
+def _flat_comments(comments):
+    """ Returns copies of all comments in a tree, without their children """
+    return [
+        dict(c, comments=[]) for _, c in _iterate_comment_tree(comments)]
+
+
+def _collect(iterable, target):
+    """ Yields all elements of iterable, and appends them to target """
+    for el in iterable:
+        target.append(el)
+        yield el
+
+
+def _merge_records(old, new, key=lambda r: r['id']):
+    """ Merges two lists of records, with new records replacing old ones """
+    merged = collections.OrderedDict((key(r), r) for r in old)
+    for r in new:
+        merged[key(r)] = r
+    return list(merged.values())
+
+
+def _iter_feed(d):
+    """ Yields the posts of the feed one at a time, so that only one post
+    (with its comments and likes) is in memory at once """
+    for post_overview in _load_data(d, 'feed'):
         post_id = post_overview['id']
         post = _load_data(d, 'post_%s' % post_id)
         post['comments'] = _load_data(d, 'comments_%s' % post_id)
         post['likes'] = _load_data(d, 'likes_%s' % post_id)
-        feed.append(post)
-    return feed
+        yield post
+
+
+def _read_all(d):
+    return list(_iter_feed(d))
 
 
 def _all_users(feed):
@@ -134,30 +1620,6 @@ def _all_users(feed):
             yield ('comment', c['from'])
 
 
-def _duplicate_names(feed):
-    """ Returns a sorted list of name -> set of ids """
-    id_by_name = collections.defaultdict(set)
-    for _, u in _all_users(feed):
-        id_by_name[u['name']].add(u['id'])
-    dupls = {
-        name: sorted(ids) for name, ids in id_by_name.items() if len(ids) > 1}
-    return sorted(dupls.items(), key=(lambda t: (-len(t[1]), t[0])))
-
-
-def _user_stats(feed):
-    """ Returns a list of tuples (id, name, {action: count}) """
-    user_dict = {}  # Key: Id Contents: (name, {action: count})
-    for action, u in _all_users(feed):
-        _, adict = user_dict.setdefault(
-            u['id'], (u['name'], collections.Counter()))
-        adict[action] += 1
-
-    users = [(uid, udata[0], udata[1]) for uid, udata in user_dict.items()]
-
-    users.sort(key=_user_key_actioncount)
-    return users
-
-
 def _user_key_commentcount(u):
     uid, uname, actions = u
     return (-actions.get('comment', 0), uname, uid)
@@ -168,6 +1630,11 @@ def _user_key_likecount(u):
     return (-actions.get('like_post', 0), uname, uid)
 
 
+def _user_key_postcount(u):
+    uid, uname, actions = u
+    return (-actions.get('post', 0), uname, uid)
+
+
 def _user_key_actioncount(u):
     uid, uname, actions = u
     return (
@@ -175,22 +1642,435 @@ def _user_key_actioncount(u):
         -actions.get('like_post', 0), uname, uid)
 
 
-def _comment_tree(comments):
-    by_id = {c['id']: c for c in comments}
-    root = []
-    for c in comments:
-        if 'parent' in c:
-            by_id[c['parent']['id']].setdefault('__children', []).append(c)
-        else:
-            root.append(c)
-    return root
+# Rankings which can be selected with the top_rankings option.
+# Key: name Contents: (title, column, key function, value function)
+USER_RANKINGS = collections.OrderedDict([
+    ('comment', (
+        'Kommentarschreiber', 'Kommentare', _user_key_commentcount,
+        lambda actions: actions.get('comment', 0))),
+    ('like_post', (
+        'Liker', 'Likes', _user_key_likecount,
+        lambda actions: actions.get('like_post', 0))),
+    ('post', (
+        'Autoren', 'Beiträge', _user_key_postcount,
+        lambda actions: actions.get('post', 0))),
+    ('total', (
+        'Aktivste Benutzer', 'Aktionen', _user_key_actioncount,
+        lambda actions: sum(actions.values()))),
+])
+
+
+class _HeapEntry(object):
+    """ Heap entry with reversed order, so that the root of a heap of these
+    is the entry with the largest key """
+    __slots__ = ('key', 'value')
+
+    def __init__(self, key, value):
+        self.key = key
+        self.value = value
+
+    def __lt__(self, other):
+        return other.key < self.key
+
+
+def _top_users(users, key_funcs, n):
+    """ Returns, for every key function, the n users with the smallest keys
+    in sorted order. Needs only a single pass over the users and
+    O(len(users) * log(n)) time. """
+    if isinstance(users, UserStats):
+        # Ranks lightweight views instead of building every user's dict
+        users = users.views()
+    heaps = [[] for _ in key_funcs]
+    for u in users:
+        for key_func, heap in zip(key_funcs, heaps):
+            key = key_func(u)
+            if len(heap) < n:
+                heapq.heappush(heap, _HeapEntry(key, u))
+            elif key < heap[0].key:
+                heapq.heapreplace(heap, _HeapEntry(key, u))
+    return [
+        [e.value for e in sorted(heap, key=lambda e: e.key)]
+        for heap in heaps]
+
+
+def _count_nonzero(arr):
+    try:
+        import numpy
+    except ImportError:
+        return sum(1 for v in arr if v)
+    return int(numpy.count_nonzero(numpy.frombuffer(arr, dtype=arr.typecode)))
 
 
-def _count_entry_users(feed):
-    by_action = collections.defaultdict(list)
-    for action, u in _all_users(feed):
-        by_action[action].append(u['id'])
-    return by_action
+def _array_sum(arr):
+    try:
+        import numpy
+    except ImportError:
+        return sum(arr)
+    return int(numpy.frombuffer(arr, dtype=arr.typecode).sum())
+
+
+class UserTable(object):
+    """ Interns user ids to consecutive integer indexes. The number of
+    actions of every user is kept in one array per action. """
+
+    def __init__(self):
+        self.index = {}  # Key: Id Contents: index
+        self.ids = []
+        self.names = []
+        self.counts = collections.OrderedDict()  # Key: action
+
+    def __len__(self):
+        return len(self.ids)
+
+    def intern(self, uid, name):
+        idx = self.index.get(uid)
+        if idx is None:
+            idx = len(self.ids)
+            self.index[uid] = idx
+            self.ids.append(uid)
+            self.names.append(name)
+            for counts in self.counts.values():
+                counts.append(0)
+        return idx
+
+    def add(self, action, uid, name):
+        idx = self.intern(uid, name)
+        counts = self.counts.get(action)
+        if counts is None:
+            counts = array.array('L', bytes(
+                array.array('L').itemsize * len(self.ids)))
+            self.counts[action] = counts
+        counts[idx] += 1
+        return idx
+
+    def actions(self, idx):
+        """ Returns a dict action -> count of one user """
+        return {
+            action: counts[idx]
+            for action, counts in self.counts.items() if counts[idx]}
+
+    def view(self, idx):
+        """ Returns a tuple (id, name, actions) of one user, where actions
+        reads the counts from the arrays """
+        return self.ids[idx], self.names[idx], _UserActions(self.counts, idx)
+
+    def action_counts(self):
+        """ Returns a dict action -> (entry count, user count) """
+        return {
+            action: (_array_sum(counts), _count_nonzero(counts))
+            for action, counts in self.counts.items()}
+
+
+class _UserActions(object):
+    """ Read-only view of the action counts of one user of a UserTable. It
+    behaves like the dict of UserTable.actions as far as the ranking
+    functions use it. """
+    __slots__ = ('counts', 'idx')
+
+    def __init__(self, counts, idx):
+        self.counts = counts
+        self.idx = idx
+
+    def get(self, action, default=None):
+        counts = self.counts.get(action)
+        if counts is None or not counts[self.idx]:
+            return default
+        return counts[self.idx]
+
+    def values(self):
+        return (
+            counts[self.idx] for counts in self.counts.values()
+            if counts[self.idx])
+
+
+class UserStats(object):
+    """ The users of a UserTable as a sequence of (id, name, {action: count})
+    tuples, ordered by _user_key_actioncount. Only the user indexes are
+    sorted, and each tuple is built when it is read. """
+
+    def __init__(self, users):
+        self.users = users
+        self.order = array.array('L', sorted(
+            range(len(users)),
+            key=lambda idx: _user_key_actioncount(users.view(idx))))
+
+    def __len__(self):
+        return len(self.order)
+
+    def __iter__(self):
+        for idx in self.order:
+            yield self.users.ids[idx], self.users.names[idx], (
+                self.users.actions(idx))
+
+    def views(self):
+        """ Yields the users as tuples of UserTable.view, in any order """
+        return (self.users.view(idx) for idx in range(len(self.users)))
+
+
+class FeedStats(object):
+    """ Collects user statistics, action counts and duplicate names of a
+    feed in a single pass over its posts """
+
+    def __init__(self):
+        self.users = UserTable()
+        self._idxs_by_name = collections.defaultdict(set)
+
+    def add(self, post):
+        for action, u in _all_users([post]):
+            idx = self.users.add(action, u['id'], u['name'])
+            self._idxs_by_name[u['name']].add(idx)
+
+    def user_stats(self):
+        """ Returns a UserStats sequence of tuples (id, name,
+        {action: count}) """
+        return UserStats(self.users)
+
+    def action_counts(self):
+        """ Returns a dict action -> (entry count, user count) """
+        return self.users.action_counts()
+
+    def user_count(self):
+        return len(self.users)
+
+    def duplicate_names(self):
+        """ Returns a sorted list of (name, sorted list of ids) """
+        dupls = {
+            name: sorted(self.users.ids[idx] for idx in idxs)
+            for name, idxs in self._idxs_by_name.items() if len(idxs) > 1}
+        return sorted(dupls.items(), key=(lambda t: (-len(t[1]), t[0])))
+
+    def result(self):
+        return (
+            self.user_stats(), self.action_counts(), self.user_count(),
+            self.duplicate_names())
+
+
+def _feed_stats(feed):
+    """ Returns a tuple (user_stats, action_counts, user_count, duplicates),
+    where action_counts maps every action to (entry count, user count) """
+    stats = FeedStats()
+    for post in feed:
+        stats.add(post)
+    return stats.result()
+
+
+SQLITE_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS snapshots (
+    name TEXT PRIMARY KEY,
+    imported REAL
+);
+CREATE TABLE IF NOT EXISTS posts (
+    snapshot TEXT,
+    post_id TEXT,
+    url TEXT,
+    source TEXT,
+    in_feed INTEGER,
+    feed_index INTEGER,
+    author_id TEXT,
+    author_name TEXT,
+    created_time TEXT,
+    medium TEXT,
+    text TEXT,
+    PRIMARY KEY (snapshot, post_id)
+);
+CREATE TABLE IF NOT EXISTS comments (
+    snapshot TEXT,
+    comment_id TEXT,
+    post_id TEXT,
+    parent_id TEXT,
+    depth INTEGER,
+    position INTEGER,
+    author_id TEXT,
+    author_name TEXT,
+    created_time TEXT,
+    like_count INTEGER,
+    text TEXT
+);
+CREATE TABLE IF NOT EXISTS likes (
+    snapshot TEXT,
+    post_id TEXT,
+    user_id TEXT,
+    user_name TEXT
+);
+CREATE TABLE IF NOT EXISTS users (
+    snapshot TEXT,
+    user_id TEXT,
+    name TEXT,
+    PRIMARY KEY (snapshot, user_id, name)
+);
+CREATE INDEX IF NOT EXISTS posts_author ON posts (snapshot, author_id);
+CREATE INDEX IF NOT EXISTS posts_created ON posts (created_time);
+CREATE INDEX IF NOT EXISTS comments_post ON comments (snapshot, post_id);
+CREATE INDEX IF NOT EXISTS comments_author ON comments (snapshot, author_id);
+CREATE INDEX IF NOT EXISTS comments_created ON comments (created_time);
+CREATE INDEX IF NOT EXISTS likes_post ON likes (snapshot, post_id);
+CREATE INDEX IF NOT EXISTS likes_user ON likes (snapshot, user_id);
+CREATE INDEX IF NOT EXISTS users_name ON users (snapshot, name);
+
+-- The actions of _all_users
+CREATE VIEW IF NOT EXISTS feed_actions AS
+    SELECT snapshot, post_id, 'post' AS action,
+        author_id AS user_id, author_name AS user_name
+    FROM posts WHERE in_feed
+    UNION ALL
+    SELECT l.snapshot, l.post_id, 'like_post', l.user_id, l.user_name
+    FROM likes l JOIN posts p USING (snapshot, post_id) WHERE p.in_feed
+    UNION ALL
+    SELECT c.snapshot, c.post_id, 'comment', c.author_id, c.author_name
+    FROM comments c JOIN posts p USING (snapshot, post_id) WHERE p.in_feed;
+'''
+
+
+def _sqlite_connect(config):
+    conn = sqlite3.connect(config['sqlite_db'])
+    conn.executescript(SQLITE_SCHEMA)
+    return conn
+
+
+def _sqlite_import(config, conn, d, url_groups):
+    """ Imports (or re-imports) the snapshot d into the database """
+    snapshot = os.path.basename(d)
+    users = set()
+
+    def _insert_post(post_id, url, source, in_feed, feed_index, post):
+        conn.execute(
+            'INSERT INTO posts VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', (
+                snapshot, post_id, url, source, in_feed, feed_index,
+                post['author_id'], post['author_name'],
+                post.get('created_time'), post.get('medium'), post['text']))
+        if post['author_id']:
+            users.add((post['author_id'], post['author_name']))
+
+    def _insert_comments(post_id, comments):
+        # comments: iterable of (depth, parent_id, comment) tuples
+        conn.executemany(
+            'INSERT INTO comments VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            ((snapshot, c.get('id'), post_id, parent_id, depth, position,
+              c.get('author_id'), c.get('author_name'),
+              c.get('created_time'), c.get('like_count'), c['text'])
+             for position, (depth, parent_id, c) in enumerate(comments)))
+
+    with conn:
+        for table in ('snapshots', 'posts', 'comments', 'likes', 'users'):
+            conn.execute(
+                'DELETE FROM %s WHERE %s = ?' % (
+                    table, 'name' if table == 'snapshots' else 'snapshot'),
+                (snapshot,))
+
+        feed = _load_optional(d, 'feed') or []
+        feed_index = {p['id']: i for i, p in enumerate(feed)}
+        urls_by_post_id = {}
+        for url in itertools.chain(*url_groups):
+            if url.startswith('http') and _facebook_post_id(url):
+                urls_by_post_id[_facebook_post_id(url)] = url
+
+        for fn in _snapshot_data_files(d):
+            name = _base_name(fn)
+            if not name.startswith('post_'):
+                continue
+            post_id = name[len('post_'):]
+            raw_post = _load_data(d, fn)
+            _insert_post(
+                post_id, urls_by_post_id.get(post_id), 'graph',
+                post_id in feed_index, feed_index.get(post_id), {
+                    'author_id': raw_post['from']['id'],
+                    'author_name': raw_post['from']['name'],
+                    'created_time': raw_post.get('created_time'),
+                    'medium': raw_post.get('type'),
+                    'text': raw_post.get('message', raw_post.get('name')),
+                })
+
+            raw_comments = _load_optional(d, 'comments_%s' % post_id) or []
+            comments = []
+            for depth, parent, rc in _walk_comment_tree(
+                    _build_comment_tree(_graph_comment_records(raw_comments))):
+                comments.append((depth, parent and parent['id'], {
+                    'id': rc['id'],
+                    'author_id': rc['from']['id'],
+                    'author_name': rc['from']['name'],
+                    'created_time': rc['created_time'],
+                    'like_count': rc.get('like_count'),
+                    'text': rc.get('message'),
+                }))
+                users.add((rc['from']['id'], rc['from']['name']))
+            _insert_comments(post_id, comments)
+
+            likes = _load_optional(d, 'likes_%s' % post_id) or []
+            conn.executemany(
+                'INSERT INTO likes VALUES (?, ?, ?, ?)',
+                ((snapshot, post_id, u['id'], u['name']) for u in likes))
+            users.update((u['id'], u['name']) for u in likes)
+
+        # Downloaded articles; Facebook posts have been imported above
+        for url in itertools.chain(*url_groups):
+            if not url.startswith('http') or _facebook_post_id(url):
+                continue
+            post = _load_optional(d, _post_name(url))
+            if post is None:
+                continue
+            _insert_post(url, url, 'article', False, None, {
+                'author_id': post.get('author_id'),
+                'author_name': post.get('author_name'),
+                'created_time': post.get('created_time'),
+                'medium': post.get('medium'),
+                'text': post['text'],
+            })
+            comments = []
+            for depth, parent, c in _walk_comment_tree(post['comments']):
+                comments.append((depth, parent and parent.get('id'), c))
+                if c.get('author_id'):
+                    users.add((c['author_id'], c['author_name']))
+            _insert_comments(url, comments)
+
+        conn.executemany(
+            'INSERT OR IGNORE INTO users VALUES (?, ?, ?)',
+            ((snapshot, uid, uname) for uid, uname in users))
+        conn.execute(
+            'INSERT INTO snapshots VALUES (?, ?)', (snapshot, time.time()))
+
+
+def _sqlite_latest(config):
+    """ Returns a tuple (connection, snapshot) if the latest snapshot has been
+    imported into the configured database, or None """
+    if not config.get('sqlite_db'):
+        return None
+    snapshot = _latest_data(config)
+    conn = _sqlite_connect(config)
+    if not conn.execute(
+            'SELECT 1 FROM snapshots WHERE name = ?', (snapshot,)).fetchone():
+        conn.close()
+        return None
+    return conn, snapshot
+
+
+def _sqlite_stats(conn, snapshot):
+    """ Returns the same as _feed_stats, computed by the database """
+    users = {}
+    for uid, uname, action, count in conn.execute('''
+            SELECT user_id, MIN(user_name), action, COUNT(*)
+            FROM feed_actions WHERE snapshot = ?
+            GROUP BY user_id, action''', (snapshot,)):
+        _, actions = users.setdefault(uid, (uname, collections.Counter()))
+        actions[action] = count
+    user_stats = [(uid, u[0], u[1]) for uid, u in users.items()]
+    user_stats.sort(key=_user_key_actioncount)
+
+    action_counts = {
+        action: (entries, user_count)
+        for action, entries, user_count in conn.execute('''
+            SELECT action, COUNT(*), COUNT(DISTINCT user_id)
+            FROM feed_actions WHERE snapshot = ?
+            GROUP BY action''', (snapshot,))}
+
+    duplicates = [
+        (name, sorted(ids.split('\t')))
+        for name, ids in conn.execute('''
+            SELECT user_name, GROUP_CONCAT(user_id, '\t') FROM (
+                SELECT DISTINCT user_name, user_id
+                FROM feed_actions WHERE snapshot = ?)
+            GROUP BY user_name HAVING COUNT(*) > 1''', (snapshot,))]
+    duplicates.sort(key=(lambda t: (-len(t[1]), t[0])))
+    return user_stats, action_counts, len(users), duplicates
 
 
 def _xslsx_write_header(worksheet, columns, row=0, column_offset=0):
@@ -213,136 +2093,528 @@ def _xslsx_write_heading_range(worksheet, title, row, col, width, height=1):
 
 
 def _xslsx_write_row(worksheet, row_num, values, column_offset=0):
-    max_height = max(
-        (v.count('\n') + 1) if isinstance(v, str) else 1
-        for v in values)
-    worksheet.set_row(row_num, 12 * max_height)
+    # The row height is computed while writing, so values can be an iterator
+    max_height = 1
     for i, v in enumerate(values, start=column_offset):
+        if isinstance(v, str):
+            max_height = max(max_height, v.count('\n') + 1)
         worksheet.write(row_num, i, v)
+    worksheet.set_row(row_num, 12 * max_height)
 
 
-def _iterate_comment_tree(comments):
-    # Yields (depth, comment) tuples
-    def _yield_recursive(depth, c):
-        yield (depth, c)
-        for child in c.get('comments', []):
-            for t in _yield_recursive(depth + 1, child):
-                yield t
+def _xslsx_write_rows(worksheet, rows, panel, start=1):
+    """ Writes rows (lists of values) from row start on, and calls the
+    functions in panel (row -> list of functions writing to that row)
+    together with the rows, so that every row is written exactly in order,
+    as required by constant_memory mode. """
+    panel_rows = collections.deque(sorted(panel))
 
-    for c in comments:
-        for t in _yield_recursive(0, c):
-            yield t
+    def _write_panel(up_to_row):
+        while panel_rows and panel_rows[0] <= up_to_row:
+            for write_func in panel[panel_rows.popleft()]:
+                write_func()
 
+    _write_panel(start - 1)
+    for row, values in enumerate(rows, start=start):
+        _xslsx_write_row(worksheet, row, values)
+        _write_panel(row)
+    _write_panel(float('inf'))
 
-def _html2xml(html):
-    return (
-        html.replace('&nbsp;', '&#160;').
-        replace('&uuml;', '&#252;').replace('&ouml;', '&#246;'))
 
+def _xslsx_workbook(config, fn):
+    """ Creates a workbook which is either kept in memory, or with the
+    xlsx_constant_memory option, streamed to disk row by row """
+    import xlsxwriter
+    constant_memory = config.get('xlsx_constant_memory', False)
+    return xlsxwriter.Workbook(fn, {
+        'strings_to_urls': False,
+        'in_memory': not constant_memory,
+        'constant_memory': constant_memory,
+    })
 
-def action_download(config, url_groups):
-    if not os.path.exists(config['download_location']):
-        os.mkdir(config['download_location'])
-    d = os.path.join(
-        config['download_location'],
-        time.strftime('%Y-%m-%dT%H:%M:%S'))
-    os.mkdir(d)
-    print('Downloading to %s' % d)
 
+HTML_VOID_ELEMENTS = frozenset([
+    'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link',
+    'meta', 'param', 'source', 'track', 'wbr'])
+
+
+class _HTMLElement(object):
+    __slots__ = ('tag', 'attrs', 'children')
+
+    def __init__(self, tag, attrs):
+        self.tag = tag
+        self.attrs = attrs
+        # Text (with entities resolved) and child elements, in order
+        self.children = []
+
+
+class _HTMLExtractor(html.parser.HTMLParser):
+    """ Parses a document in a single pass, and only builds trees of the
+    elements for which match(tag, attrs) is true. The contents of scripts,
+    styles and SVG images are skipped. """
+
+    SKIPPED = frozenset(['script', 'style', 'svg'])
+
+    def __init__(self, match):
+        super(_HTMLExtractor, self).__init__(convert_charrefs=True)
+        self._match = match
+        self.elements = []
+        self._stack = []
+        self._skip_tag = None
+        self._skip_depth = 0
+
+    def handle_starttag(self, tag, attrs):
+        if self._skip_tag:
+            if tag == self._skip_tag:
+                self._skip_depth += 1
+            return
+        if tag in self.SKIPPED:
+            self._skip_tag = tag
+            self._skip_depth = 1
+            return
+        attrs = dict(attrs)
+        if self._stack:
+            el = _HTMLElement(tag, attrs)
+            self._stack[-1].children.append(el)
+        elif self._match(tag, attrs):
+            el = _HTMLElement(tag, attrs)
+            self.elements.append(el)
+        else:
+            return
+        if tag not in HTML_VOID_ELEMENTS:
+            self._stack.append(el)
+
+    def handle_endtag(self, tag):
+        if self._skip_tag:
+            if tag == self._skip_tag:
+                self._skip_depth -= 1
+                if not self._skip_depth:
+                    self._skip_tag = None
+            return
+        # Implicitly closes unclosed elements such as <p> or <li>
+        for i in range(len(self._stack) - 1, -1, -1):
+            if self._stack[i].tag == tag:
+                del self._stack[i:]
+                break
+
+    def handle_data(self, data):
+        if self._stack and not self._skip_tag:
+            self._stack[-1].children.append(data)
+
+
+def _extract_html(document, match):
+    """ Returns the outermost elements of document matching match """
+    extractor = _HTMLExtractor(match)
+    extractor.feed(document)
+    extractor.close()
+    return extractor.elements
+
+
+def _html_selector(tag=None, cls=None, **attrs):
+    """ Returns a function match(tag, attrs) which is true for elements with
+    the given tag, class and attribute values """
+    def match(el_tag, el_attrs):
+        return (
+            (tag is None or el_tag == tag) and
+            (cls is None or cls in (el_attrs.get('class') or '').split()) and
+            all(el_attrs.get(k) == v for k, v in attrs.items()))
+    return match
+
+
+def _html_iter(el):
+    # Yields all descendant elements of el in document order
+    stack = [iter(el.children)]
+    while stack:
+        for child in stack[-1]:
+            if isinstance(child, _HTMLElement):
+                yield child
+                stack.append(iter(child.children))
+                break
+        else:
+            stack.pop()
+
+
+def _html_find_all(el, match):
+    return [e for e in _html_iter(el) if match(e.tag, e.attrs)]
+
+
+def _html_find(el, match):
+    return next((e for e in _html_iter(el) if match(e.tag, e.attrs)), None)
+
+
+def _html_text(el):
+    parts = []
+    stack = [iter(el.children)]
+    while stack:
+        for child in stack[-1]:
+            if isinstance(child, str):
+                parts.append(child)
+            else:
+                stack.append(iter(child.children))
+                break
+        else:
+            stack.pop()
+    return ''.join(parts)
+
+
+def _html_tail(parent, el):
+    """ Returns the text directly following el in its parent """
+    children = parent.children
+    parts = []
+    for child in children[children.index(el) + 1:]:
+        if not isinstance(child, str):
+            break
+        parts.append(child)
+    return ''.join(parts)
+
+
+FACEBOOK_POST_PATTERN = (
+    r'https://www\.facebook\.com/[^/]+/(?:posts|videos|photos/[^/]+)/'
+    r'([0-9]+)')
+_FACEBOOK_POST_RE = re.compile(FACEBOOK_POST_PATTERN)
+
+
+def _facebook_post_id(url):
+    fbpost_m = _FACEBOOK_POST_RE.match(url)
+    return fbpost_m.group(1) if fbpost_m else None
+
+
+# Site extractors by name, in registration order
+Extractor = collections.namedtuple(
+    'Extractor', ['name', 'pattern', 'host', 'func', 'workers', 'rate'])
+EXTRACTORS = collections.OrderedDict()
+
+
+def register_extractor(name, pattern, host, workers=None, rate=None):
+    """ Decorator registering func(config, d, url, prev_d=None) as the
+    downloader of all URLs matching the regular expression pattern.
+
+    name must be a valid identifier, and pattern must not set global flags.
+    workers is the number of concurrent downloads from host, and rate the
+    number of requests per second to it. Both default to the configuration
+    (max_workers_per_host and rate_limits), which takes precedence. """
+    def decorator(func):
+        EXTRACTORS[name] = Extractor(
+            name, re.compile(pattern), host, func, workers, rate)
+        _dispatch_re.cache_clear()
+        return func
+    return decorator
+
+
+@functools.lru_cache(maxsize=None)
+def _dispatch_re():
+    # One regular expression with a named group per extractor
+    return re.compile('|'.join(
+        '(?P<%s>%s)' % (e.name, e.pattern.pattern)
+        for e in EXTRACTORS.values()))
+
+
+def _extractor(url):
+    """ Returns the Extractor responsible for url, or None """
+    m = _dispatch_re().match(url)
+    return EXTRACTORS[m.lastgroup] if m else None
+
+
+def _host_workers(config, host):
+    """ Returns the number of concurrent downloads from host """
+    configured = config.get('host_workers', {}).get(host)
+    if configured:
+        return configured
+    for e in EXTRACTORS.values():
+        if e.host == host and e.workers:
+            return e.workers
+    return config.get('max_workers_per_host', 2)
+
+
+def _host_limiter(config, host):
+    """ Returns the semaphore which limits the concurrent downloads from host
+    during action_download, or None """
+    return config.get('_host_limiters', {}).get(host)
+
+
+def _rate_limits(config):
+    # Requests per second by host, from the extractors and the configuration
+    rate_limits = {e.host: e.rate for e in EXTRACTORS.values() if e.rate}
+    rate_limits.update(config.get('rate_limits') or {})
+    return rate_limits
+
+
+def _download_jobs(config, d, url_groups, prev_d=None):
+    # Yields (url, host, func, args) tuples
     for url_group in url_groups:
         for url in url_group:
-            fbpost_m = re.match(
-                r'(?x)^https://www\.facebook\.com/' +
-                r'[^/]+/(?:posts|videos|photos/[^/]+)/([0-9]+)', url)
-            if fbpost_m:
-                download_facebook_post(config, d, fbpost_m.group(1), url)
-            elif re.match(r'^https?://www\.zeit\.de/', url):
-                download_zeit(config, d, url)
-            elif re.match(r'^https?://www\.welt\.de/', url):
-                download_welt(config, d, url)
-            elif re.match(r'^https?://www\.spiegel\.de/', url):
-                download_spiegel(config, d, url)
-            elif re.match(r'^https?://www\.sueddeutsche\.de/', url):
-                download_sz(config, d, url)
+            extractor = _extractor(url)
+            if extractor:
+                yield (
+                    url, extractor.host, extractor.func,
+                    (config, d, url, prev_d))
             else:
                 assert 'http' not in url, 'URL %s is not a facebook page' % url
-                download_facebook_page(config, d, url)
-
-
-def download_zeit(config, d, url):
-    webpage = _download_webpage(url)
-    m = re.search(r'''(?x)
-        <li\s+class="pager__page">\s*
-        <a\s+href="(?P<paging_url>.*?\?page=)(?P<pagecount>[0-9]+)\#comments">
-        \s*[0-9]+\s*
-        </a>\s*</li>\s*</ul>
-        ''', webpage)
-    pagecount = int(m.group('pagecount'))
-    paging_url = m.group('paging_url')
-
-    title = re.search(r'''(?x)
-        <span\s+class="article-heading__title">\s*(.*?)\s*</span>
-        ''', webpage).group(1)
+                yield (
+                    url, 'graph.facebook.com', download_facebook_page,
+                    (config, d, url, prev_d))
+
+
+def _run_download_job(journal, manifest, url, func, args):
+    start = time.monotonic()
+    errors = True
+    try:
+        errors = func(*args)
+    finally:
+        manifest.add_url(url, time.monotonic() - start, not errors)
+    if not errors:
+        journal.mark_done('url:' + url)
+    return errors
+
+
+def _run_download_jobs(config, journal, manifest, jobs):
+    """ Runs the download jobs of _download_jobs concurrently. Returns a list
+    of (url, exception) tuples of the failed downloads. """
+    # Jobs wait in a queue per host, and are only handed to the pool once
+    # their host has a free slot, so that no worker blocks on a busy host.
+    queues = collections.OrderedDict()
+    for job in jobs:
+        queues.setdefault(job[1], collections.deque()).append(job)
+    limiters = {
+        host: threading.BoundedSemaphore(_host_workers(config, host))
+        for host in queues}
+    config['_host_limiters'] = limiters
+    max_workers = config.get('max_workers', 4)
+
+    errors = []
+    futures = {}
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers) as executor:
+        while True:
+            for host, queue in queues.items():
+                while (queue and len(futures) < max_workers and
+                        limiters[host].acquire(blocking=False)):
+                    url, _, func, args = queue.popleft()
+                    future = executor.submit(
+                        _run_download_job, journal, manifest, url, func, args)
+                    futures[future] = (url, host)
+            if not futures:
+                break
+            done, _ = concurrent.futures.wait(
+                futures, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                url, host = futures.pop(future)
+                limiters[host].release()
+                try:
+                    job_errors = future.result()
+                except Exception as e:
+                    if config.get('verbose'):
+                        traceback.print_exc()
+                    errors.append((url, e))
+                    continue
+                if job_errors:
+                    errors.extend(job_errors)
+            # The files of finished jobs stay listed if the download is
+            # killed later on
+            manifest.save()
+    del config['_host_limiters']
+    return errors
+
+
+def action_download(config, url_groups):
+    if not os.path.exists(config['download_location']):
+        os.mkdir(config['download_location'])
+    snapshots = _snapshots(config)
+    resume_d = None
+    if config.get('resume') and snapshots:
+        resume_d = os.path.join(config['download_location'], snapshots[-1])
+        manifest = Manifest.load(resume_d)
+        if manifest and manifest.complete:
+            print('The download to %s is complete already' % resume_d)
+            resume_d = None
+    if resume_d:
+        d = resume_d
+        snapshots.pop()
+        print('Resuming download to %s' % d)
+    else:
+        d = os.path.join(
+            config['download_location'],
+            time.strftime('%Y-%m-%dT%H:%M:%S'))
+        os.mkdir(d)
+        print('Downloading to %s' % d)
+    prev_d = None
+    # A failed download may have left truncated files behind
+    prev_snapshot = config.get('incremental') and _latest_complete(
+        snapshots, config)
+    if prev_snapshot:
+        prev_d = os.path.join(config['download_location'], prev_snapshot)
+        print('Only downloading new comments since %s' % prev_d)
+    journal = Journal(d)
+    config['_journal'] = journal
+    manifest = Manifest(d)
+    config['_manifest'] = manifest
+    if resume_d and manifest.add_unlisted_files():
+        # Written by an interrupted run after it last saved the manifest
+        manifest.save()
+
+    jobs = [
+        job for job in _download_jobs(config, d, url_groups, prev_d)
+        if not journal.is_done('url:' + job[0])]
+    try:
+        errors = _run_download_jobs(config, journal, manifest, jobs)
+    finally:
+        # Also on KeyboardInterrupt, so that --resume knows the files
+        manifest.save()
+    _http(config).close()
+    del config['_journal']
+    # A complete snapshot is never resumed, so its journal is not needed
+    if errors:
+        journal.close()
+    else:
+        journal.remove()
+
+    # Precomputed so that count_users does not need to read the snapshot
+    if _data_path(d, 'feed') and not errors:
+        manifest.users = _users_summary(d)
+    manifest.complete = not errors
+    _update_index(config, os.path.basename(d), manifest.save())
+    del config['_manifest']
+
+    if config.get('sqlite_db'):
+        conn = _sqlite_connect(config)
+        _sqlite_import(config, conn, d, url_groups)
+        conn.close()
+        print('Imported %s into %s' % (d, config['sqlite_db']))
+
+    if errors:
+        print('The following downloads failed:')
+        for url, e in errors:
+            if isinstance(e, urllib.error.HTTPError):
+                print('%s (%d)' % (url, e.code))
+            else:
+                print('%s (%s)' % (url, e))
+        print('Run with --resume to continue the download.')
+        sys.exit(1)
+
+
+@register_extractor('zeit', r'https?://www\.zeit\.de/', 'www.zeit.de')
+def download_zeit(config, d, url, prev_d=None):
+    webpage = _download_webpage(config, url)
+    with METRICS.timer('parse', 'www.zeit.de'):
+        m = re.search(r'''(?x)
+            <li\s+class="pager__page">\s*
+            <a\s+href="(?P<paging_url>.*?\?page=)(?P<pagecount>[0-9]+)
+                \#comments">
+            \s*[0-9]+\s*
+            </a>\s*</li>\s*</ul>
+            ''', webpage)
+        pagecount = int(m.group('pagecount'))
+        paging_url = m.group('paging_url')
+
+        title = html.unescape(re.search(r'''(?x)
+            <span\s+class="article-heading__title">\s*(.*?)\s*</span>
+            ''', webpage).group(1))
     if config.get('verbose'):
         print(title)
 
-    comments = []
-    last_toplevel = None
-    for page in range(1, pagecount + 1):
-        if config.get('verbose'):
-            print('.. %d/%d' % (page, pagecount))
-        p = _download_webpage(paging_url + str(page))
-        section_xml = re.search(
-            r'''(?sx)(<section\s+class="comment-section"\s+id="comments">
-                .*?</section>)''', p).group(1)
-        section_xml = re.sub(r'(?s)<script(.*?)</script>', '', section_xml)
-        section_xml = re.sub(r'(?s)<svg(.*?)</svg>', '', section_xml)
-        section_xml = _html2xml(section_xml)
-        section_xml = re.sub(
-            r'(<(?:img|br)[^>]*)(?<!.../)>',
-            lambda m: m.group(1) + '/>',
-            section_xml)
-        section = xml.etree.ElementTree.fromstring(section_xml)
-        for article in section.findall('.//article'):
-            author_node = article.find('.//*[@class="comment-meta__name"]/a')
-            author_id = re.match(
-                r'.*community\.zeit\.de/user/(?P<user_id>[^/]+)$',
-                author_node.attrib['href']).group('user_id')
-            body = article.find('.//*[@class="comment__body"]')
-            comment = {
-                'id': article.attrib['id'],
-                'author_id': author_id,
-                'author_name': author_node.text,
-                'text': _node_text(body).strip(),
-                'comments': [],
-            }
-            is_toplevel = 'js-comment-toplevel' in article.attrib['class']
+    # Comments are sorted oldest first, so in incremental mode only the
+    # pages from the previously last one onwards can contain new comments.
+    previous = _load_optional(prev_d, _post_name(url))
+    first_page = 1
+    records = []
+    # Replies follow their top-level comment, so they are attached to it
+    toplevel_ids = {}
+    last_toplevel_id = None
+    if previous:
+        first_page = max(1, previous.get('page_count', 1) - 1)
+        for _, parent, c in _walk_comment_tree(previous['comments']):
+            parent_id = parent['id'] if parent else None
+            records.append((c, parent_id))
+            last_toplevel_id = toplevel_ids[c['id']] = parent_id or c['id']
+
+    page_urls = [
+        paging_url + str(page) for page in range(first_page, pagecount + 1)]
+    for page_comments in _download_pages(
+            config, page_urls, _parse_zeit_page):
+        for comment, is_toplevel in page_comments:
+            if comment['id'] in toplevel_ids:
+                last_toplevel_id = toplevel_ids[comment['id']]
+                continue
             if is_toplevel:
-                comments.append(comment)
-                last_toplevel = comment
+                last_toplevel_id = comment['id']
             else:
-                assert last_toplevel
-                last_toplevel['comments'].append(comment)
+                assert last_toplevel_id
+            toplevel_ids[comment['id']] = last_toplevel_id
+            records.append(
+                (comment, None if is_toplevel else last_toplevel_id))
+    comments = _build_comment_tree(records)
 
     post = {
         'text': title,
         'medium': 'article',
+        'page_count': pagecount,
         'comments': comments
     }
-    _write_post(d, url, post)
-
-
-def _download_disqus(config, disqus_forum, disqus_identifier):
-    disqus_url = (
-        'http://disqus.com/embed/comments/?base=default&version=' +
-        config['disqus_version'] + '&f=' + disqus_forum +
-        '&t_i=' + disqus_identifier + '&t_t=volk')
-    disqus_embed = _download_webpage(disqus_url)
-    disqus_thread = re.search(r'"thread":"([0-9]+)"', disqus_embed).group(1)
+    _write_post(config, d, url, post)
+
+
+def _parse_zeit_page(p):
+    """ Returns a list of (comment, is_toplevel) tuples """
+    res = []
+    section, = _extract_html(p, _html_selector(
+        'section', 'comment-section', id='comments'))
+    for article in _html_find_all(section, _html_selector('article')):
+        author_node = _html_find(
+            _html_find(article, _html_selector(cls='comment-meta__name')),
+            _html_selector('a'))
+        author_id = re.match(
+            r'.*community\.zeit\.de/user/(?P<user_id>[^/]+)$',
+            author_node.attrs['href']).group('user_id')
+        body = _html_find(article, _html_selector(cls='comment__body'))
+        comment = {
+            'id': article.attrs['id'],
+            'author_id': author_id,
+            'author_name': _html_text(author_node),
+            'text': _html_text(body).strip(),
+            'comments': [],
+        }
+        is_toplevel = 'js-comment-toplevel' in article.attrs['class'].split()
+        res.append((comment, is_toplevel))
+    return res
+
+
+def _download_disqus(config, disqus_forum, disqus_identifier, previous=None):
+    """ Returns a tuple (comments, disqus_thread, cursor).
+
+    cursor is the cursor of the last page, from which an incremental
+    download can continue when passed the previously written post. """
+    if previous and previous.get('disqus_thread'):
+        disqus_thread = previous['disqus_thread']
+    else:
+        disqus_url = (
+            'http://disqus.com/embed/comments/?base=default&version=' +
+            config['disqus_version'] + '&f=' + disqus_forum +
+            '&t_i=' + disqus_identifier + '&t_t=volk')
+        disqus_embed = _download_webpage(config, disqus_url)
+        disqus_thread = re.search(
+            r'"thread":"([0-9]+)"', disqus_embed).group(1)
 
     all_comments = []
     cursor = '0:0:0'
+    if previous and previous.get('disqus_cursor'):
+        all_comments = _flat_comments(previous['comments'])
+        cursor = previous['disqus_cursor']
+    new_comments = []
+
+    journal = config.get('_journal')
+    journal_key = 'disqus:%s:%s' % (disqus_thread, cursor)
+    has_next = True
+    if journal:
+        for next_cursor, records in journal.pages(journal_key):
+            new_comments.extend(records)
+            if next_cursor is None:
+                has_next = False
+            else:
+                cursor = next_cursor
+
     for page in itertools.count():
+        if not has_next:
+            break
         if config.get('verbose'):
             print('.. %d' % (page + 1))
         page_url = (
@@ -356,8 +2628,10 @@ def _download_disqus(config, disqus_forum, disqus_identifier):
                 'order': 'asc',
             })
         )
-        cpage_json = _download_webpage(page_url)
-        cpage = json.loads(cpage_json)
+        cpage_json = _download_webpage(config, page_url)
+        with METRICS.timer('parse', 'disqus.com'):
+            cpage = json.loads(cpage_json)
+        page_comments = []
         for cdata in cpage['response']:
             c = {
                 'id': cdata['id'],
@@ -371,27 +2645,26 @@ def _download_disqus(config, disqus_forum, disqus_identifier):
             author_id = cdata['author'].get('username')
             if author_id:
                 c['author_id'] = author_id
-            all_comments.append(c)
-        if not cpage['cursor']['hasNext']:
-            break
-        cursor = cpage['cursor']['next']
-
-    comments_by_id = {int(c['id']): c for c in all_comments}
-
-    comments = []
-    for c in all_comments:
-        if c['parent_id']:
-            parent_id = int(c['parent_id'])
-            assert parent_id in comments_by_id
-            comments_by_id[parent_id]['comments'].append(c)
-        else:
-            comments.append(c)
-
-    return comments
-
-
-def download_welt(config, d, url):
-    webpage = _download_webpage(url)
+            page_comments.append(c)
+        new_comments.extend(page_comments)
+        has_next = cpage['cursor']['hasNext']
+        if journal:
+            journal.add_page(
+                journal_key, cpage['cursor']['next'] if has_next else None,
+                page_comments)
+        if has_next:
+            cursor = cpage['cursor']['next']
+    all_comments = _merge_records(all_comments, new_comments)
+    comments = _build_comment_tree(
+        (c, str(c['parent_id']) if c['parent_id'] else None)
+        for c in all_comments)
+
+    return comments, disqus_thread, cursor
+
+
+@register_extractor('welt', r'https?://www\.welt\.de/', 'www.welt.de')
+def download_welt(config, d, url, prev_d=None):
+    webpage = _download_webpage(config, url)
     disqus_forum = re.search(
         r"var disqus_shortname='([^']+)';", webpage).group(1)
     disqus_identifier = re.search(
@@ -402,23 +2675,27 @@ def download_welt(config, d, url):
     if config.get('verbose'):
         print(title)
 
-    comments = _download_disqus(config, disqus_forum, disqus_identifier)
+    comments, disqus_thread, disqus_cursor = _download_disqus(
+        config, disqus_forum, disqus_identifier,
+        _load_optional(prev_d, _post_name(url)))
 
     post = {
         'text': title,
         'medium': 'article',
+        'disqus_thread': disqus_thread,
+        'disqus_cursor': disqus_cursor,
         'comments': comments,
     }
-    _write_post(d, url, post)
+    _write_post(config, d, url, post)
 
 
-def download_spiegel(config, d, url):
-    webpage = _download_webpage(url)
-    title_html = re.search(
-        r'(?s)<h2 class="article-title(?: lp-article-title)?">.*?</h2>',
-        webpage).group(0)
-    title_node = xml.etree.ElementTree.fromstring(title_html)
-    title = _node_text(title_node).strip()
+@register_extractor('spiegel', r'https?://www\.spiegel\.de/', 'www.spiegel.de')
+def download_spiegel(config, d, url, prev_d=None):
+    webpage = _download_webpage(config, url)
+    with METRICS.timer('parse', 'www.spiegel.de'):
+        title_node = _extract_html(
+            webpage, _html_selector('h2', 'article-title'))[0]
+        title = _html_text(title_node).strip()
 
     if config.get('verbose'):
         print(title)
@@ -430,50 +2707,84 @@ def download_spiegel(config, d, url):
         r'<input type="hidden" name="threadid" value="([0-9]+)" />', webpage
     ).group(1)
 
+    page_urls = [
+        'http://www.spiegel.de/fragments/community/spon-%s-%d.html' % (
+            thread_id, page * 5)
+        for page in range(1, page_count + 1)]
+
+    # Comments are sorted newest first, so in incremental mode we can stop
+    # at the first batch of pages which contains a known comment.
+    previous = _load_optional(prev_d, _post_name(url))
+    if previous:
+        known = set(map(_spiegel_comment_key, previous['comments']))
+        batch_size = config.get('page_workers', 4)
+        page_batches = [
+            page_urls[i:i + batch_size]
+            for i in range(0, len(page_urls), batch_size)]
+    else:
+        known = set()
+        page_batches = [page_urls]
+
     comments = []
-    for page in range(1, page_count + 1):
-        if config.get('verbose'):
-            print('.. %d/%d' % (page, page_count))
-        page_url = (
-            'http://www.spiegel.de/fragments/community/spon-%s-%d.html' % (
-                thread_id, page * 5))
-        page_html = _download_webpage(page_url)
-        page_html = '<page>%s</page>' % page_html
-        page_node = xml.etree.ElementTree.fromstring(page_html)
-
-        for c in page_node.findall('./div[@class="article-comment"]'):
-            user_node = c.find('.//div[@class="article-comment-user"]/a')
-            date = user_node.tail.strip()
-            author_id = re.match(
-                r'/forum/member-([0-9]+)\.html',
-                user_node.attrib['href']).group(1)
-            author_name = user_node.text
-
-            text = _node_text(c.find(
-                './/*[@class="js-article-post-full-text"]')).strip()
-            comments.append({
-                'text': text,
-                'created_time': date,
-                'author_id': author_id,
-                'author_name': author_name,
-                'comments': []
-            })
+    for batch in page_batches:
+        batch_comments = list(itertools.chain(*_download_pages(
+            config, batch, _parse_spiegel_page)))
+        new_comments = list(itertools.takewhile(
+            lambda c: _spiegel_comment_key(c) not in known, batch_comments))
+        comments.extend(new_comments)
+        if len(new_comments) < len(batch_comments):
+            break
+    if previous:
+        comments.extend(previous['comments'])
 
     post = {
         'text': title,
         'medium': 'article',
         'comments': comments
     }
-    _write_post(d, url, post)
+    _write_post(config, d, url, post)
+
+
+def _spiegel_comment_key(c):
+    # Spiegel comments do not have an id
+    return (c['author_id'], c['created_time'], c['text'])
+
+
+def _parse_spiegel_page(page_html):
+    comments = []
+    for c in _extract_html(
+            page_html, _html_selector('div', 'article-comment')):
+        user_div = _html_find(
+            c, _html_selector('div', 'article-comment-user'))
+        user_node = next(
+            e for e in user_div.children
+            if isinstance(e, _HTMLElement) and e.tag == 'a')
+        date = _html_tail(user_div, user_node).strip()
+        author_id = re.match(
+            r'/forum/member-([0-9]+)\.html',
+            user_node.attrs['href']).group(1)
+        author_name = _html_text(user_node)
+
+        text = _html_text(_html_find(
+            c, _html_selector(cls='js-article-post-full-text'))).strip()
+        comments.append({
+            'text': text,
+            'created_time': date,
+            'author_id': author_id,
+            'author_name': author_name,
+            'comments': []
+        })
+    return comments
 
 
-def download_sz(config, d, url):
-    webpage = _download_webpage(url)
-    title_xml = _html2xml(re.search(
-        r'<h1 itemprop="headline">.*?</h1>',
-        webpage).group(0))
-    title_node = xml.etree.ElementTree.fromstring(title_xml)
-    title = _node_text(title_node).strip()
+@register_extractor(
+    'sz', r'https?://www\.sueddeutsche\.de/', 'www.sueddeutsche.de')
+def download_sz(config, d, url, prev_d=None):
+    webpage = _download_webpage(config, url)
+    with METRICS.timer('parse', 'www.sueddeutsche.de'):
+        title_node = _extract_html(
+            webpage, _html_selector('h1', itemprop='headline'))[0]
+        title = _html_text(title_node).strip()
 
     if config.get('verbose'):
         print(title)
@@ -483,18 +2794,22 @@ def download_sz(config, d, url):
         webpage).group(1)
     disqus_data = json.loads(disqus_json)['widget.Disqus']
 
-    comments = _download_disqus(
-        config, disqus_data['shortName'], disqus_data['identifier'])
+    comments, disqus_thread, disqus_cursor = _download_disqus(
+        config, disqus_data['shortName'], disqus_data['identifier'],
+        _load_optional(prev_d, _post_name(url)))
 
     post = {
         'text': title,
         'medium': 'article',
+        'disqus_thread': disqus_thread,
+        'disqus_cursor': disqus_cursor,
         'comments': comments
     }
-    _write_post(d, url, post)
+    _write_post(config, d, url, post)
 
 
-def download_facebook_page(config, d, page):
+def download_facebook_page(config, d, page, prev_d=None):
+    # Returns a list of (post_id, error) tuples
     filter_func = None
     if config.get('feedmessage_grep'):
         def filter_func(p):
@@ -506,86 +2821,121 @@ def download_facebook_page(config, d, page):
     feed = graph_api(config, '%s/feed' % page, params={
         'fields': 'id,message'
     }, filter_func=filter_func)
-    _write_data(d, 'feed', feed)
-
-    errors = []
-    for post_overview in feed:
-        post_id = post_overview['id']
-        post_error = download_facebook_post(config, post_id)
-        if post_error:
-            errors.append(post_error)
-
-    if errors:
-        print('The following posts failed to load:')
-        for post_id, he in errors:
-            print('%s (%d)' % (post_id, he.code))
-
-        sys.exit(1)
+    _write_data(config, d, 'feed', feed)
 
+    journal = config.get('_journal')
+    post_ids = [
+        post_overview['id'] for post_overview in feed
+        if not (journal and journal.is_done('post:' + post_overview['id']))]
 
-def download_facebook_post(config, d, post_id, url=None):
-    try:
-        raw_post = graph_api(config, '%s' % post_id)
-    except urllib.error.HTTPError as he:
-        if config.get('abort_on_error', True):
-            raise
-        else:
-            return (post_id, he)
-    _write_data(d, 'post_%s' % post_id, raw_post)
+    errors = []
+    for i in range(0, len(post_ids), GRAPH_BATCH_SIZE):
+        batch_ids = post_ids[i:i + GRAPH_BATCH_SIZE]
+        raw_posts = graph_batch(config, [
+            '%s?fields=%s' % (post_id, _graph_post_fields(
+                not _has_data(prev_d, 'comments_%s' % post_id)))
+            for post_id in batch_ids])
+        for post_id, raw_post in zip(batch_ids, raw_posts):
+            # Failed sub-requests are repeated on their own
+            post_errors = download_facebook_post(
+                config, d, post_id, prev_d=prev_d, raw_post=raw_post)
+            if post_errors:
+                errors.extend(post_errors)
+            elif journal:
+                journal.mark_done('post:' + post_id)
+    return errors
+
+
+@register_extractor(
+    'facebook_post', FACEBOOK_POST_PATTERN, 'graph.facebook.com')
+def download_facebook_url(config, d, url, prev_d=None):
+    return download_facebook_post(
+        config, d, _facebook_post_id(url), url, prev_d)
+
+
+def download_facebook_post(config, d, post_id, url=None, prev_d=None,
+                           raw_post=None):
+    # raw_post can be prefetched with the fields of _graph_post_fields
+    prev_comments = _load_optional(prev_d, 'comments_%s' % post_id)
+    if raw_post is None:
+        try:
+            raw_post = graph_api(config, '%s' % post_id, {
+                'fields': _graph_post_fields(prev_comments is None),
+            })
+        except urllib.error.HTTPError as he:
+            if config.get('abort_on_error', True):
+                raise
+            else:
+                return [(post_id, he)]
+    _write_data(config, d, 'post_%s' % post_id, raw_post)
 
-    raw_comments = graph_api(
-        config, '%s/comments' % post_id,
-        {
+    if prev_comments is not None:
+        params = {
             'filter': 'stream',
-            'fields': 'parent,id,message,created_time,from,like_count'
-        })
-    _write_data(d, 'comments_%s' % post_id, raw_comments)
-
-    likes = graph_api(
-        config, '%s/likes' % post_id, {})
-    _write_data(d, 'likes_%s' % post_id, likes)
+            'fields': GRAPH_COMMENT_FIELDS,
+        }
+        if prev_comments:
+            params['since'] = max(rc['created_time'] for rc in prev_comments)
+        raw_comments = graph_api(config, '%s/comments' % post_id, params)
+        raw_comments = _merge_records(prev_comments, raw_comments)
+        _write_records(config, d, 'comments_%s' % post_id, raw_comments)
+    elif url:
+        raw_comments = []
+        _write_records(
+            config, d, 'comments_%s' % post_id,
+            _collect(_graph_edge(config, raw_post, 'comments'), raw_comments))
+    else:
+        _write_records(
+            config, d, 'comments_%s' % post_id,
+            _graph_edge(config, raw_post, 'comments'))
+
+    like_count = _write_records(
+        config, d, 'likes_%s' % post_id,
+        _graph_edge(config, raw_post, 'likes'))
 
     if not url:
         return
 
-    comments_by_id = {}
-    comments = []
-
-    for rc in raw_comments:
-        c = {
-            'id': rc['id'],
-            'created_time': rc['created_time'],
-            'text': rc['message'],
-            'like_count': rc['like_count'],
-            'author_id': rc['from']['id'],
-            'author_name': rc['from']['name'],
-            'comments': [],
-        }
-        comments_by_id[c['id']] = c
-        if rc.get('parent'):
-            parent_id = rc['parent']['id']
-            parent_c = comments_by_id[parent_id]
-            parent_c['comments'].append(c)
-        else:
-            comments.append(c)
+    comments = _build_comment_tree(({
+        'id': rc['id'],
+        'created_time': rc['created_time'],
+        'text': rc['message'],
+        'like_count': rc['like_count'],
+        'author_id': rc['from']['id'],
+        'author_name': rc['from']['name'],
+    }, parent_id) for rc, parent_id in _graph_comment_records(raw_comments))
 
     post = {
         'id': post_id,
         'text': raw_post.get('message', raw_post.get('name')),
         'comments': comments,
         'created_time': raw_post['created_time'],
-        'like_count': (
-            len(raw_post['likes']) if 'likes' in raw_post else ''),
+        'like_count': like_count,
         'share_count': raw_post.get('shares', {'count': ''})['count'],
         'author_id': raw_post['from']['id'],
         'author_name': raw_post['from']['name'],
         'medium': raw_post.get('type', 'unbekannt'),
     }
-    _write_post(d, url, post)
-
+    _write_post(config, d, url, post)
+
+
+def action_comment_stats(config, url_groups):
+    db = _sqlite_latest(config)
+    if db:
+        conn, snapshot = db
+        count, = conn.execute('''
+            SELECT COUNT(*) FROM comments JOIN posts USING (snapshot, post_id)
+            WHERE snapshot = ? AND source = 'graph'
+            ''', (snapshot,)).fetchone()
+        conn.close()
+        print('%d comments' % count)
+        return
 
-def action_comment_stats(config):
     d = os.path.join(config['download_location'], _latest_data(config))
+    manifest = Manifest.load(d)
+    if manifest:
+        print('%d comments' % manifest.totals()['graph_comments'])
+        return
     count = 0
     for fn in os.listdir(d):
         if not fn.startswith('comments_'):
@@ -595,14 +2945,13 @@ def action_comment_stats(config):
     print('%d comments' % count)
 
 
-def action_write_page_x(config):
-    import xlsxwriter
+def action_write_page_x(config, url_groups):
     latest_d = _latest_data(config)
     d = os.path.join(config['download_location'], latest_d)
     fn = os.path.join(d, 'stats.xlsx')
+    start = time.monotonic()
 
-    workbook = xlsxwriter.Workbook(
-        fn, {'strings_to_urls': False, 'in_memory': True})
+    workbook = _xslsx_workbook(config, fn)
     workbook.set_properties({
         'title': 'Facebook-Analyse von %s' % latest_d,
         'author': 'Philipp Hagemeister',
@@ -624,9 +2973,12 @@ def action_write_page_x(config):
         'ID', 'Datum', 'Likes', 'Shares', 'Autor-Id', 'Autor', 'Medium',
         'Beitrag', 'Kommentar', 'Antwort'])
 
+    db = _sqlite_latest(config)
+    feed_stats = None if db else FeedStats()
     row = 1
-    feed = _read_all(d)
-    for post in feed:
+    for post in _iter_feed(d):
+        if feed_stats:
+            feed_stats.add(post)
         _xslsx_write_row(worksheet, row, [
             post['id'],
             post['created_time'],
@@ -637,7 +2989,9 @@ def action_write_page_x(config):
             post.get('type', 'unbekannt'),
             post['message']
         ])
-        for depth, c in _iterate_comment_tree(post['comments']):
+        comments = _build_comment_tree(
+            _graph_comment_records(post['comments']))
+        for depth, c in _iterate_comment_tree(comments):
             row += 1
             _xslsx_write_row(worksheet, row, [
                 post['id'],
@@ -652,167 +3006,692 @@ def action_write_page_x(config):
 
     worksheet = workbook.add_worksheet('Benutzer')
     worksheet._fbc_formats = fbc_formats
-    _xslsx_write_header(worksheet, [
-        'ID', 'Name', 'Kommentare', 'Likes', 'Aktionen gesamt'])
-    user_stats = _user_stats(feed)
-    for row, s in enumerate(user_stats, start=1):
-        uid, uname, actions = s
-        _xslsx_write_row(
-            worksheet, row,
-            [uid, uname, actions.get('comment'),
-             actions.get('like_post'), sum(actions.values())])
-
+    if db:
+        conn, snapshot = db
+        user_stats, action_counts, user_count, duplicates = _sqlite_stats(
+            conn, snapshot)
+        conn.close()
+    else:
+        user_stats, action_counts, user_count, duplicates = (
+            feed_stats.result())
+
+    # The statistics next to the user list are written together with it
+    panel = collections.defaultdict(list)
     column_offset = 8
-    _xslsx_write_header(
-        worksheet, row=0, column_offset=column_offset + 1,
-        columns=['Anzahl', 'Benutzer'])
-    by_action = _count_entry_users(feed)
-    all_user_actions = set(itertools.chain(*by_action.values()))
-    _xslsx_write_row(
-        worksheet, 1, column_offset=column_offset,
+    panel[0].append(functools.partial(
+        _xslsx_write_header, worksheet, row=0,
+        column_offset=column_offset + 1, columns=['Anzahl', 'Benutzer']))
+    panel[1].append(functools.partial(
+        _xslsx_write_row, worksheet, 1, column_offset=column_offset,
         values=[
             'Insgesamt',
-            sum(len(v) for v in by_action.values()),
-            len(all_user_actions)])
-    _xslsx_write_row(
-        worksheet, 2, column_offset=column_offset,
-        values=[
-            'Post likes',
-            len(by_action['like_post']),
-            len(set(by_action['like_post']))])
-    _xslsx_write_row(
-        worksheet, 3, column_offset=column_offset,
-        values=[
-            'Kommentare',
-            len(by_action['comment']),
-            len(set(by_action['comment']))])
-
-    top_count = 30
-
-    _xslsx_write_heading_range(
-        worksheet, 'Top 30 Kommentarschreiber',
-        row=5, col=column_offset, width=3)
-    _xslsx_write_header(
-        worksheet, ['Name', 'Id', 'Kommentare'],
-        row=6, column_offset=column_offset)
-    top_comments = sorted(user_stats, key=_user_key_commentcount)[:top_count]
-    for row, u in enumerate(top_comments, 7):
-        _xslsx_write_row(
-            worksheet, values=[u[1], u[0], u[2].get('comment', 0)],
-            row_num=row, column_offset=column_offset)
-
-    _xslsx_write_heading_range(
-        worksheet, 'Top 30 Liker', row=5, col=column_offset + 4, width=3)
-    _xslsx_write_header(
-        worksheet, ['Name', 'Id', 'Likes'],
-        row=6, column_offset=column_offset + 4)
-    top_likes = sorted(user_stats, key=_user_key_likecount)[:top_count]
-    for row, u in enumerate(top_likes, 7):
-        _xslsx_write_row(
-            worksheet, values=[u[1], u[0], u[2].get('like_post', 0)],
-            row_num=row, column_offset=column_offset + 4)
-
-    _xslsx_write_heading(
-        worksheet, 'Mehrfache Namen', row=10 + top_count, col=column_offset)
+            sum(entries for entries, _ in action_counts.values()),
+            user_count]))
+    panel[2].append(functools.partial(
+        _xslsx_write_row, worksheet, 2, column_offset=column_offset,
+        values=['Post likes'] + list(action_counts.get('like_post', (0, 0)))))
+    panel[3].append(functools.partial(
+        _xslsx_write_row, worksheet, 3, column_offset=column_offset,
+        values=['Kommentare'] + list(action_counts.get('comment', (0, 0)))))
+
+    top_count = config.get('top_count', 30)
+    rankings = [
+        USER_RANKINGS[name]
+        for name in config.get('top_rankings', ['comment', 'like_post'])]
+    top_lists = _top_users(
+        user_stats, [key_func for _, _, key_func, _ in rankings], top_count)
+    for i, ((title, column, _, value_func), top_users) in enumerate(
+            zip(rankings, top_lists)):
+        ranking_offset = column_offset + 4 * i
+        panel[5].append(functools.partial(
+            _xslsx_write_heading_range,
+            worksheet, 'Top %d %s' % (top_count, title),
+            row=5, col=ranking_offset, width=3))
+        panel[6].append(functools.partial(
+            _xslsx_write_header,
+            worksheet, ['Name', 'Id', column],
+            row=6, column_offset=ranking_offset))
+        for row, u in enumerate(top_users, 7):
+            panel[row].append(functools.partial(
+                _xslsx_write_row,
+                worksheet, values=[u[1], u[0], value_func(u[2])],
+                row_num=row, column_offset=ranking_offset))
+
+    panel[10 + top_count].append(functools.partial(
+        _xslsx_write_heading,
+        worksheet, 'Mehrfache Namen', row=10 + top_count, col=column_offset))
     for row, (name, ids) in enumerate(
-            _duplicate_names(feed), start=10 + top_count + 1):
-        _xslsx_write_row(
+            duplicates, start=10 + top_count + 1):
+        panel[row].append(functools.partial(
+            _xslsx_write_row,
             worksheet, values=[name] + ids,
-            row_num=row, column_offset=column_offset)
+            row_num=row, column_offset=column_offset))
+
+    _xslsx_write_header(worksheet, [
+        'ID', 'Name', 'Kommentare', 'Likes', 'Aktionen gesamt'])
+    _xslsx_write_rows(worksheet, (
+        [uid, uname, actions.get('comment'),
+         actions.get('like_post'), sum(actions.values())]
+        for uid, uname, actions in user_stats), panel)
 
     workbook.close()
+    # Includes reading the snapshot, which is also counted separately
+    METRICS.add(
+        'xlsx', 'write_page_x', time.monotonic() - start,
+        os.path.getsize(fn))
     print('Wrote %s' % fn)
 
 
+def _write_group_x(config, d, url_group):
+    """ Writes the workbook of one url_group into d/comments and returns a
+    tuple (filename, seconds, bytes). Runs in a worker process. """
+    start = time.monotonic()
+    latest_d = os.path.basename(d)
+    out_dir = os.path.join(d, 'comments')
+    sample_post = _load_post(d, url_group[-1])
+    title = re.sub(r'[^a-zA-ZöäüßÖÄÜ 0-9_-]+', '_', sample_post['text'])
+    fn = os.path.join(out_dir, '%s.xlsx' % title)
+    tmp_fn = '%s.%d.tmp' % (fn, os.getpid())
+
+    workbook = _xslsx_workbook(config, tmp_fn)
+    workbook.set_properties({
+        'title': 'Kommentar-Analyse von %s' % latest_d,
+        'author': 'Philipp Hagemeister',
+        'company': 'HHU Düsseldorf',
+        'comments':
+        'Erstellt mit fbcomments (https://github.com/hhucn/fbcomments)',
+    })
+
+    fbc_formats = {
+        'heading': workbook.add_format({'bold': True}),
+        'heading_range': workbook.add_format(
+            {'bold': True, 'align': 'center'}),
+        'header': workbook.add_format({'bold': True, 'bottom': 1}),
+        'cell': workbook.add_format({'text_wrap': True})
+    }
+
+    for url in url_group:
+        service = re.match(
+            r'^https?://(?:www\.)?([a-z0-9]+)\.[a-z]+/', url).group(1)
+
+        worksheet = workbook.add_worksheet(service)
+        worksheet._fbc_formats = fbc_formats
+        _xslsx_write_header(worksheet, [
+            'ID', 'Datum', 'Likes', 'Shares', 'Autor-Id', 'Autor',
+            'Medium', 'Beitrag', 'Kommentar', 'Antwort'])
+
+        post = _load_post(d, url)
+        row = 1
+        _xslsx_write_row(worksheet, row, [
+            post.get('id', url),
+            post.get('created_time', ''),
+            post.get('like_count', ''),
+            post.get('share_count', ''),
+            post.get('author_id', ''),
+            post.get('author_name', ''),
+            post.get('type', ''),
+            post['text']
+        ])
+        for depth, c in _iterate_comment_tree(post['comments']):
+            row += 1
+            _xslsx_write_row(worksheet, row, [
+                c.get('id', ''),
+                c.get('created_time', ''),
+                c.get('like_count', ''),
+                '',
+                c.get('author_id', ''),
+                c.get('author_name', ''),
+                c.get('medium', ''),
+                '',  # Beitrag
+            ] + [''] * depth + [c['text']])
+
+    try:
+        workbook.close()
+        os.replace(tmp_fn, fn)
+    except BaseException:
+        if os.path.exists(tmp_fn):
+            os.remove(tmp_fn)
+        raise
+    return fn, time.monotonic() - start, os.path.getsize(fn)
+
+
 def action_write_x(config, url_groups):
-    import xlsxwriter
+    """ Writes one workbook per url_group, in parallel worker processes.
+    Returns a list of (filename, seconds, bytes) tuples. """
     latest_d = _latest_data(config)
     d = os.path.join(config['download_location'], latest_d)
-    for url_group in url_groups:
-        out_dir = os.path.join(d, 'comments')
-        if not os.path.exists(out_dir):
-            os.mkdir(out_dir)
-        sample_post = _load_post(d, url_group[-1])
-        title = re.sub(r'[^a-zA-ZöäüßÖÄÜ 0-9_-]+', '_', sample_post['text'])
-        fn = os.path.join(out_dir, '%s.xlsx' % title)
-
-        workbook = xlsxwriter.Workbook(
-            fn, {'strings_to_urls': False, 'in_memory': True})
-        workbook.set_properties({
-            'title': 'Kommentar-Analyse von %s' % latest_d,
-            'author': 'Philipp Hagemeister',
-            'company': 'HHU Düsseldorf',
-            'comments':
-            'Erstellt mit fbcomments (https://github.com/hhucn/fbcomments)',
-        })
-
-        fbc_formats = {
-            'heading': workbook.add_format({'bold': True}),
-            'heading_range': workbook.add_format(
-                {'bold': True, 'align': 'center'}),
-            'header': workbook.add_format({'bold': True, 'bottom': 1}),
-            'cell': workbook.add_format({'text_wrap': True})
+    out_dir = os.path.join(d, 'comments')
+    if not os.path.exists(out_dir):
+        os.mkdir(out_dir)
+
+    # Per-run objects such as the HTTP connections cannot be pickled
+    worker_config = {
+        k: v for k, v in config.items() if not k.startswith('_')}
+    workers = config.get('xlsx_workers') or os.cpu_count() or 1
+    start = time.monotonic()
+    summary = []
+    if workers == 1 or len(url_groups) <= 1:
+        for url_group in url_groups:
+            summary.append(_write_group_x(worker_config, d, url_group))
+            print('Wrote %s' % summary[-1][0])
+    else:
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=workers) as executor:
+            futures = [
+                executor.submit(_write_group_x, worker_config, d, url_group)
+                for url_group in url_groups]
+            for future in futures:
+                summary.append(future.result())
+                print('Wrote %s' % summary[-1][0])
+
+    for fn, seconds, size in summary:
+        # Worker processes cannot record into METRICS themselves
+        METRICS.add('xlsx', 'write_x', seconds, size)
+        print('%8.2fs %10d bytes  %s' % (seconds, size, os.path.basename(fn)))
+    print('%d workbooks in %.2fs' % (len(summary), time.monotonic() - start))
+    return summary
+
+
+# Columns and (pyarrow) types of the tables written by action_export_tables
+EXPORT_TABLES = collections.OrderedDict([
+    ('posts', [
+        ('source', 'string'), ('post_id', 'string'),
+        ('created_time', 'string'), ('like_count', 'int64'),
+        ('share_count', 'int64'), ('author_id', 'string'),
+        ('author_name', 'string'), ('medium', 'string'), ('text', 'string'),
+    ]),
+    ('comments', [
+        ('source', 'string'), ('post_id', 'string'),
+        ('comment_id', 'string'), ('parent_id', 'string'), ('depth', 'int64'),
+        ('created_time', 'string'), ('like_count', 'int64'),
+        ('author_id', 'string'), ('author_name', 'string'),
+        ('text', 'string'),
+    ]),
+    ('users', [
+        ('user_id', 'string'), ('name', 'string'), ('comments', 'int64'),
+        ('likes', 'int64'), ('posts', 'int64'), ('total', 'int64'),
+    ]),
+])
+
+
+class _TableWriter(object):
+    """ Streams rows to name.csv and, if pyarrow is installed, to
+    name.parquet with typed columns """
+
+    BATCH_SIZE = 10000
+
+    def __init__(self, out_dir, name, columns):
+        self.filenames = [os.path.join(out_dir, name + '.csv')]
+        self._types = [t for _, t in columns]
+        self._csv_file = open(
+            self.filenames[0], 'w', encoding='utf-8', newline='')
+        self._csv = csv.writer(self._csv_file)
+        self._csv.writerow([c for c, _ in columns])
+        self._parquet = None
+        self._batch = []
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            return
+        self._schema = pyarrow.schema(
+            [(c, getattr(pyarrow, t)()) for c, t in columns])
+        self.filenames.append(os.path.join(out_dir, name + '.parquet'))
+        self._parquet = pyarrow.parquet.ParquetWriter(
+            self.filenames[1], self._schema)
+
+    def write(self, row):
+        row = [
+            _int_or_none(v) if t == 'int64' else v
+            for v, t in zip(row, self._types)]
+        self._csv.writerow(row)
+        if self._parquet is not None:
+            self._batch.append(row)
+            if len(self._batch) >= self.BATCH_SIZE:
+                self._flush()
+
+    def _flush(self):
+        import pyarrow
+        self._parquet.write_table(pyarrow.Table.from_arrays(
+            [pyarrow.array(col, type=field.type)
+             for col, field in zip(zip(*self._batch), self._schema)],
+            schema=self._schema))
+        self._batch = []
+
+    def close(self):
+        if self._parquet is not None:
+            if self._batch:
+                self._flush()
+            self._parquet.close()
+        self._csv_file.close()
+
+
+def _int_or_none(v):
+    try:
+        return int(v)
+    except (TypeError, ValueError):
+        return None
+
+
+def _export_feed(source, d, tables, feed_stats):
+    for post in _iter_feed(d):
+        feed_stats.add(post)
+        tables['posts'].write([
+            source, post['id'], post['created_time'], len(post['likes']),
+            post.get('shares', {'count': None})['count'],
+            post['from']['id'], post['from']['name'],
+            post.get('type', 'unbekannt'), post.get('message')])
+        for depth, parent, c in _walk_comment_tree(_build_comment_tree(
+                _graph_comment_records(post['comments']))):
+            tables['comments'].write([
+                source, post['id'], c['id'], parent and parent['id'], depth,
+                c['created_time'], c['like_count'],
+                c['from']['id'], c['from']['name'], c['message']])
+
+
+def _export_post(url, post, tables):
+    post_id = post.get('id', url)
+    tables['posts'].write([
+        url, post_id, post.get('created_time'), post.get('like_count'),
+        post.get('share_count'), post.get('author_id'),
+        post.get('author_name'), post.get('medium'), post['text']])
+    for depth, parent, c in _walk_comment_tree(post['comments']):
+        tables['comments'].write([
+            url, post_id, c.get('id'), parent and parent.get('id'), depth,
+            c.get('created_time'), c.get('like_count'),
+            c.get('author_id'), c.get('author_name'), c['text']])
+
+
+def action_export_tables(config, url_groups):
+    """ Writes the posts, comments (with depth and parent id) and user
+    statistics of the latest snapshot to CSV (and Parquet) files in
+    export/, for loading them with pandas or DuckDB """
+    d = os.path.join(config['download_location'], _latest_data(config))
+    out_dir = os.path.join(d, 'export')
+    if not os.path.exists(out_dir):
+        os.mkdir(out_dir)
+
+    tables = collections.OrderedDict(
+        (name, _TableWriter(out_dir, name, columns))
+        for name, columns in EXPORT_TABLES.items())
+    feed_stats = FeedStats()
+    try:
+        for url_group in url_groups:
+            for url in url_group:
+                if 'http' in url:
+                    _export_post(url, _load_post(d, url), tables)
+                else:
+                    _export_feed(url, d, tables, feed_stats)
+
+        for uid, name, actions in feed_stats.user_stats():
+            tables['users'].write([
+                uid, name, actions.get('comment', 0),
+                actions.get('like_post', 0), actions.get('post', 0),
+                sum(actions.values())])
+    finally:
+        for table in tables.values():
+            table.close()
+    for table in tables.values():
+        for fn in table.filenames:
+            print('Wrote %s' % fn)
+
+
+TIMESERIES_CACHE = 'timeseries.json'
+TIMESERIES_VERSION = 2
+# Columns and (pyarrow) types of the tables written by action_timeseries
+TIMESERIES_TABLES = collections.OrderedDict([
+    ('snapshots', [
+        ('snapshot', 'string'), ('posts', 'int64'), ('comments', 'int64'),
+        ('likes', 'int64'), ('users', 'int64'), ('new_users', 'int64'),
+    ]),
+    ('posts', [
+        ('snapshot', 'string'), ('post', 'string'), ('comments', 'int64'),
+        ('likes', 'int64'), ('participants', 'int64'),
+        ('new_comments', 'int64'), ('new_likes', 'int64'),
+        ('new_participants', 'int64'),
+    ]),
+    ('users', [
+        ('snapshot', 'string'), ('user_id', 'string'), ('name', 'string'),
+        ('comments', 'int64'), ('likes', 'int64'),
+        ('new_comments', 'int64'), ('new_likes', 'int64'),
+    ]),
+])
+
+
+def _snapshot_series(d, urls):
+    """ Returns the per-post and per-user counts of one snapshot, and the
+    sorted ids of the participants of every post """
+    posts = {}
+    users = {}
+
+    def _count(uid, name, action, participants):
+        user = users.get(uid)
+        if user is None:
+            user = users[uid] = {'name': name, 'comments': 0, 'likes': 0}
+        user[action] += 1
+        participants.add(uid)
+
+    if _data_path(d, 'feed'):
+        for post in _iter_feed(d):
+            participants = set()
+            for c in post['comments']:
+                _count(
+                    c['from']['id'], c['from']['name'], 'comments',
+                    participants)
+            for u in post['likes']:
+                _count(u['id'], u['name'], 'likes', participants)
+            posts[post['id']] = {
+                'comments': len(post['comments']),
+                'likes': len(post['likes']),
+                'participants': sorted(participants),
+            }
+    for url in urls:
+        post = _load_optional(d, _post_name(url))
+        if post is None:
+            continue
+        participants = set()
+        comment_count = 0
+        for _, c in _iterate_comment_tree(post['comments']):
+            comment_count += 1
+            if c.get('author_id'):
+                _count(
+                    c['author_id'], c.get('author_name'), 'comments',
+                    participants)
+        posts[url] = {
+            'comments': comment_count,
+            'likes': _int_or_none(post.get('like_count')) or 0,
+            'participants': sorted(participants),
         }
+    return {'posts': posts, 'users': users}
 
-        for url in url_group:
-            service = re.match(
-                r'^https?://(?:www\.)?([a-z0-9]+)\.[a-z]+/', url).group(1)
 
-            worksheet = workbook.add_worksheet(service)
-            worksheet._fbc_formats = fbc_formats
-            _xslsx_write_header(worksheet, [
-                'ID', 'Datum', 'Likes', 'Shares', 'Autor-Id', 'Autor',
-                'Medium', 'Beitrag', 'Kommentar', 'Antwort'])
+def _cached_snapshot_series(d, urls):
+    """ Returns _snapshot_series(d, urls), computing it only once for every
+    snapshot (unless the snapshot or the urls change) """
+    manifest = Manifest.load(d)
+    key = {
+        'version': TIMESERIES_VERSION,
+        'urls': sorted(urls),
+        'totals': manifest.totals() if manifest else None,
+    }
+    fn = os.path.join(d, TIMESERIES_CACHE)
+    if os.path.exists(fn):
+        cached = _read_json(fn)
+        if cached['key'] == key:
+            return cached['series']
+    series = _snapshot_series(d, urls)
+    _write_json_atomic(fn, {'key': key, 'series': series})
+    return series
+
+
+def action_timeseries(config, url_groups):
+    """ Writes the growth of comments, likes and participants per post and
+    per user across all snapshots to timeseries/ in the download location,
+    as CSV (and Parquet) files and unless timeseries_xlsx is false, as a
+    workbook. Every snapshot is only read once; its counts are cached.
+    Snapshots of failed or running downloads are skipped. """
+    urls = [
+        url for url in itertools.chain(*url_groups) if url.startswith('http')]
+    out_dir = os.path.join(config['download_location'], 'timeseries')
+    if not os.path.exists(out_dir):
+        os.mkdir(out_dir)
+
+    tables = collections.OrderedDict(
+        (name, _TableWriter(out_dir, name, columns))
+        for name, columns in TIMESERIES_TABLES.items())
+    workbook = None
+    if config.get('timeseries_xlsx', True):
+        workbook = _xslsx_workbook(
+            config, os.path.join(out_dir, 'timeseries.xlsx'))
+        header_format = workbook.add_format({'bold': True, 'bottom': 1})
+        sheets = {}
+        for name, columns in TIMESERIES_TABLES.items():
+            worksheet = workbook.add_worksheet(name)
+            worksheet._fbc_formats = {'header': header_format}
+            _xslsx_write_header(worksheet, [c for c, _ in columns])
+            sheets[name] = [worksheet, 1]
+
+    def _write(name, row):
+        tables[name].write(row)
+        if workbook:
+            sheet = sheets[name]
+            _xslsx_write_row(sheet[0], sheet[1], row)
+            sheet[1] += 1
+
+    empty = {'comments': 0, 'likes': 0, 'participants': []}
+    prev = {'posts': {}, 'users': {}}
+    seen_users = set()
+    try:
+        for snapshot in _snapshots(config):
+            if not _snapshot_complete(config, snapshot):
+                print('Skipped %s, its download is incomplete' % snapshot)
+                continue
+            d = os.path.join(config['download_location'], snapshot)
+            try:
+                series = _cached_snapshot_series(d, urls)
+            except (IOError, ValueError) as e:
+                print('Skipped %s: %s' % (snapshot, e))
+                continue
+            posts, users = series['posts'], series['users']
+            new_users = len(users.keys() - seen_users)
+            seen_users.update(users)
+            _write('snapshots', [
+                snapshot, len(posts),
+                sum(p['comments'] for p in posts.values()),
+                sum(p['likes'] for p in posts.values()),
+                len(users), new_users])
+            for post_key, p in sorted(posts.items()):
+                before = prev['posts'].get(post_key, empty)
+                _write('posts', [
+                    snapshot, post_key, p['comments'], p['likes'],
+                    len(p['participants']),
+                    p['comments'] - before['comments'],
+                    p['likes'] - before['likes'],
+                    len(set(p['participants']).difference(
+                        before['participants']))])
+            for uid, u in sorted(users.items()):
+                before = prev['users'].get(uid, empty)
+                _write('users', [
+                    snapshot, uid, u['name'], u['comments'], u['likes'],
+                    u['comments'] - before['comments'],
+                    u['likes'] - before['likes']])
+            prev = series
+            print('Processed %s' % snapshot)
+    finally:
+        for table in tables.values():
+            table.close()
+        if workbook:
+            workbook.close()
+    print('Wrote %s' % out_dir)
+
+
+def _snapshot_data_files(d):
+    """ Yields the file names of all downloaded data in a snapshot """
+    for fn in sorted(os.listdir(d)):
+        if (fn in SNAPSHOT_META_FILES or fn.startswith('.') or
+                fn.endswith('.xlsx') or
+                os.path.isdir(os.path.join(d, fn))):
+            continue
+        yield fn
 
-            post = _load_post(d, url)
-            row = 1
-            _xslsx_write_row(worksheet, row, [
-                post.get('id', url),
-                post.get('created_time', ''),
-                post.get('like_count', ''),
-                post.get('share_count', ''),
-                post.get('author_id', ''),
-                post.get('author_name', ''),
-                post.get('type', ''),
-                post['text']
-            ])
-            for depth, c in _iterate_comment_tree(post['comments']):
-                row += 1
-                _xslsx_write_row(worksheet, row, [
-                    c.get('id', ''),
-                    c.get('created_time', ''),
-                    c.get('like_count', ''),
-                    '',
-                    c.get('author_id', ''),
-                    c.get('author_name', ''),
-                    c.get('medium', ''),
-                    '',  # Beitrag
-                ] + [''] * depth + [c['text']])
 
-        workbook.close()
-        print('Wrote %s' % fn)
+def action_convert_storage(config, url_groups):
+    """ Converts all complete snapshots to the configured storage_format """
+    for snapshot in _snapshots(config):
+        d = os.path.join(config['download_location'], snapshot)
+        # The manifest entries are updated by _write_data
+        manifest = Manifest.load(d)
+        if manifest and manifest.complete is False:
+            print('Skipping %s, its download is incomplete' % d)
+            continue
+        converted = 0
+        config['_manifest'] = manifest
+        try:
+            for fn in _snapshot_data_files(d):
+                path = os.path.join(d, fn)
+                name = _base_name(fn)
+                try:
+                    data = _load_data(d, fn)
+                except (IOError, ValueError) as e:
+                    print('Skipping %s: %s' % (path, e))
+                    continue
+                if _data_fn(config, d, name, isinstance(data, list)) == path:
+                    continue
+                _write_data(config, d, name, data)
+                os.remove(path)
+                converted += 1
+        finally:
+            del config['_manifest']
+            if manifest:
+                _update_index(config, snapshot, manifest.save())
+        print('Converted %d files in %s' % (converted, d))
+
+
+def _latest_stats(config):
+    db = _sqlite_latest(config)
+    if db:
+        conn, snapshot = db
+        res = _sqlite_stats(conn, snapshot)
+        conn.close()
+        return res
+    d = os.path.join(config['download_location'], _latest_data(config))
+    return _feed_stats(_iter_feed(d))
 
 
-def action_count_users(config):
+def _users_summary(d):
+    _, action_counts, user_count, _ = _feed_stats(_iter_feed(d))
+    return {
+        'user_count': int(user_count),
+        'action_counts': {
+            action: [int(entries), int(users)]
+            for action, (entries, users) in action_counts.items()},
+    }
+
+
+def action_count_users(config, url_groups):
     d = os.path.join(config['download_location'], _latest_data(config))
-    feed = _read_all(d)
-    by_action = _count_entry_users(feed)
-    all_users = set(itertools.chain(*by_action.values()))
-    print('%d unique users' % len(all_users))
+    manifest = Manifest.load(d)
+    if manifest and manifest.users:
+        user_count = manifest.users['user_count']
+        action_counts = manifest.users['action_counts']
+    else:
+        _, action_counts, user_count, _ = _latest_stats(config)
+    print('%d unique users' % user_count)
     action_str = ',  '.join(
-        '%s: %d entries, %d users' % (action_name, len(users), len(set(users)))
-        for action_name, users in by_action.items()
+        '%s: %d entries, %d users' % (action_name, entries, users)
+        for action_name, (entries, users) in action_counts.items()
     )
     print('By action: %s' % action_str)
 
 
-def action_duplicate_names(config):
-    d = os.path.join(config['download_location'], _latest_data(config))
-    feed = _read_all(d)
-    for name, ids in _duplicate_names(feed):
+def action_duplicate_names(config, url_groups):
+    _, _, _, duplicates = _latest_stats(config)
+    for name, ids in duplicates:
         print("%s: %s" % (name, ', '.join(ids)))
 
 
+def action_update_manifests(config, url_groups):
+    """ Writes the manifests of snapshots which do not have one yet, and
+    rebuilds the snapshot index """
+    for snapshot in _snapshots(config):
+        d = os.path.join(config['download_location'], snapshot)
+        manifest = Manifest.load(d)
+        if manifest is None:
+            manifest = Manifest(d)
+            # Unknown for snapshots downloaded without a manifest
+            manifest.complete = None
+            manifest.add_unlisted_files()
+            if _data_path(d, 'feed'):
+                manifest.users = _users_summary(d)
+            print('Wrote %s' % manifest.fn)
+        _update_index(config, snapshot, manifest.save())
+
+
+def action_verify(config, url_groups):
+    """ Checks the data files of all snapshots against their manifests """
+    problems = 0
+    for snapshot in _snapshots(config):
+        d = os.path.join(config['download_location'], snapshot)
+        manifest = Manifest.load(d)
+        if manifest is None:
+            print('%s: no manifest (run update_manifests)' % snapshot)
+            continue
+        listed = set()
+        snapshot_problems = []
+        for name, entry in sorted(manifest.files.items()):
+            listed.add(entry['file'])
+            path = os.path.join(d, entry['file'])
+            if not os.path.exists(path):
+                snapshot_problems.append('%s is missing' % entry['file'])
+            elif (os.path.getsize(path) != entry['bytes'] or
+                    _file_sha256(path) != entry['sha256']):
+                snapshot_problems.append('%s has changed' % entry['file'])
+            elif path.endswith(DEDUP_REF_SUFFIX):
+                objects_dir = _objects_dir(d)
+                for h in _ref_objects(_read_json(path)):
+                    if _data_path(_object_dir(objects_dir, h), h) is None:
+                        snapshot_problems.append('%s refers to missing %s' % (
+                            entry['file'], h))
+        for fn in _snapshot_data_files(d):
+            if fn not in listed:
+                snapshot_problems.append('%s is not in the manifest' % fn)
+        if manifest.complete is False:
+            snapshot_problems.append('the download did not complete')
+        for problem in snapshot_problems:
+            print('%s: %s' % (snapshot, problem))
+        if not snapshot_problems:
+            print('%s: %d files OK' % (snapshot, len(manifest.files)))
+        problems += len(snapshot_problems)
+    if problems:
+        sys.exit(1)
+
+
+def action_gc(config, url_groups):
+    """ Deletes the objects of the deduplicating store which no snapshot
+    refers to any more. Must not run while a download is in progress. """
+    objects_dir = os.path.join(config['download_location'], DEDUP_OBJECTS)
+    if not os.path.isdir(objects_dir):
+        print('There is no object store in %s' % config['download_location'])
+        return
+    referenced = set()
+    for snapshot in _snapshots(config):
+        d = os.path.join(config['download_location'], snapshot)
+        for fn in os.listdir(d):
+            if fn.endswith(DEDUP_REF_SUFFIX):
+                ref = _read_json(os.path.join(d, fn))
+                referenced.update(_ref_objects(ref))
+
+    kept = removed = freed = 0
+    for sub in sorted(os.listdir(objects_dir)):
+        obj_dir = os.path.join(objects_dir, sub)
+        for fn in os.listdir(obj_dir):
+            # Files starting with . are left over from aborted writes
+            if not fn.startswith('.') and _base_name(fn) in referenced:
+                kept += 1
+                continue
+            path = os.path.join(obj_dir, fn)
+            freed += os.path.getsize(path)
+            os.remove(path)
+            removed += 1
+        if not os.listdir(obj_dir):
+            os.rmdir(obj_dir)
+    print('Removed %d objects (%d bytes), kept %d' % (removed, freed, kept))
+
+
+def action_sqlite_import(config, url_groups):
+    """ Imports all snapshots which are not in the database yet """
+    conn = _sqlite_connect(config)
+    imported = set(
+        name for name, in conn.execute('SELECT name FROM snapshots'))
+    for snapshot in _snapshots(config):
+        if snapshot in imported:
+            continue
+        d = os.path.join(config['download_location'], snapshot)
+        _sqlite_import(config, conn, d, url_groups)
+        print('Imported %s' % d)
+    conn.close()
+
+
 def main():
     action_list = [
         g[len('action_'):] for g in globals() if g.startswith('action_')]
@@ -825,6 +3704,18 @@ def main():
         dest='config_file_location',
         help='Configuration file (in JSON format) to read from',
         default='config.json')
+    parser.add_argument(
+        '--incremental', action='store_true',
+        help='Only download comments which are newer than the latest snapshot')
+    parser.add_argument(
+        '--resume', action='store_true',
+        help='Continue the interrupted download of the latest snapshot')
+    parser.add_argument(
+        '--profile', action='store_true',
+        help='Print the time spent per phase and site when done')
+    parser.add_argument(
+        '--metrics-file', metavar='FILE',
+        help='Write the time spent per phase and site to FILE as JSON')
     parser.add_argument(
         'action', metavar='ACTION',
         help='One of ' + ', '.join(action_list)
@@ -832,8 +3723,26 @@ def main():
     args = parser.parse_args()
 
     config = _read_json(args.config_file_location)
+    if args.incremental:
+        config['incremental'] = True
+    if args.resume:
+        config['resume'] = True
+    if args.profile:
+        config['profile'] = True
+    if args.metrics_file:
+        config['metrics_file'] = args.metrics_file
     url_groups = _read_json(config['urls_file'])
-    globals()['action_%s' % args.action](config, url_groups)
+
+    METRICS.enabled = bool(
+        config.get('profile') or config.get('metrics_file'))
+    try:
+        globals()['action_%s' % args.action](config, url_groups)
+    finally:
+        if config.get('profile'):
+            print(METRICS.report())
+        if config.get('metrics_file'):
+            with io.open(config['metrics_file'], 'w', encoding='utf-8') as f:
+                json.dump(METRICS.as_json(), f, indent=2)
 
 
 if __name__ == '__main__':